@@ -8,7 +8,16 @@
 #
 # Usage:
 #
-# This script does not accept any command line options or arguments.
+# artroot_filter.py [--jobs <n>] [--cache <path>]
+#
+# Options:
+#
+# --jobs <n>     - Number of worker processes (default is the smaller of 4
+#                  and the number of cpus this process may run on).
+# --cache <path> - Remember results for local files in a persistent cache
+#                  (dbm database <path>), indexed by file path, modification
+#                  time, and size, so that unchanged files are not reopened
+#                  on subsequent invocations.  Default is no cache.
 #
 # Examples:
 #
@@ -22,60 +31,558 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os
+import collections
+try:
+    import dbm
+except ImportError:
+    import anydbm as dbm
+import io
+import multiprocessing
+import struct
+try:
+    from urllib.parse import urlparse
+    import urllib.request as urlrequest
+except ImportError:
+    from urlparse import urlparse
+    import urllib2 as urlrequest
+
+# Root module.
+# Root is only used by worker processes, so it is imported and initialized
+# by the worker pool initializer (init_root), not by the main process.
+
+ROOT = None
+
+# Compiled helper functions.
+# These are declared to the root interpreter once, when root is initialized
+# (see init_root), so that checking a file (open, check, and close) costs a
+# single python to C++ call.
+#
+# artroot_filter::inherits - Test whether a class inherits from a base class.
+#                            Results are cached indexed by (class, base).
+#                            Unknown classes don't inherit from anything.
+#
+# artroot_filter::is_artroot - Test whether an opened root file is an artroot file.
+#                              To qualify as an artroot file, this file must
+#                              contain the following objects:
+#                              1.  A TTree called 'Events'
+#                              2.  A TKey called 'RootFileDB'
+#                              Keys are looked up directly by name, and objects
+#                              are identified using the class name stored in
+#                              the key, so that no objects need to be read from
+#                              the file.  Any key satisfies the RootFileDB
+#                              requirement.  Required keys are listed in table
+#                              artroot_filter::required_keys.
+#
+# artroot_filter::check_file - Finish opening a file started by TFile::AsyncOpen,
+#                              test whether it is an artroot file, and close
+#                              (and delete) the file.  Returns 1 for an artroot
+#                              file, 0 for a file that isn't an artroot file,
+#                              or -1 if the file could not be opened.
+
+helper_code = r'''
+#include "TClass.h"
+#include "TDirectory.h"
+#include "TFile.h"
+#include "TKey.h"
+#include <map>
+#include <string>
+#include <utility>
+
+namespace artroot_filter {
+
+  bool inherits(const char* clsname, const char* base)
+  {
+    static std::map<std::pair<std::string, std::string>, bool> cache;
+    std::pair<std::string, std::string> k(clsname, base);
+    std::map<std::pair<std::string, std::string>, bool>::const_iterator i = cache.find(k);
+    if(i != cache.end())
+      return i->second;
+    TClass* cls = TClass::GetClass(clsname);
+    bool result = cls != 0 && cls->InheritsFrom(base);
+    cache[k] = result;
+    return result;
+  }
+
+  // Required keys (name, base class).  A null base class matches any key.
+
+  const char* const required_keys[][2] = {
+    {"Events", "TTree"},
+    {"RootFileDB", 0}
+  };
+
+  bool is_artroot(TDirectory* dir)
+  {
+    for(const char* const* req : required_keys) {
+      TKey* key = dir->GetKey(req[0]);
+      if(key == 0 || (req[1] != 0 && !inherits(key->GetClassName(), req[1])))
+        return false;
+    }
+    return true;
+  }
+
+  int check_file(TFileOpenHandle* handle)
+  {
+    // Wait for the open to complete (blocks only if it hasn't already).
+
+    TFile* root = TFile::Open(handle);
+    if(root == 0)
+      return -1;
+    // A successfully opened file is never returned in the closed state, so
+    // only the zombie check is needed.
+
+    int result = root->IsZombie() ? -1 : (is_artroot(root) ? 1 : 0);
+    root->Close();
+    delete root;
+    return result;
+  }
+}
+'''
+
+# Import and initialize ROOT (worker pool initializer).
+
+def init_root():
+
+    global ROOT
+
+    # Import ROOT module.
+    # Globally turn off root warning and error messages.
+    # Don't let root see our command line options.
+
+    myargv = sys.argv
+    sys.argv = myargv[0:1]
+    if 'TERM' in os.environ:
+        del os.environ['TERM']
+    import ROOT
+    ROOT.gErrorIgnoreLevel = ROOT.kFatal
+    sys.argv = myargv
+
+    # Only file metadata (keys) is read, so turn off readahead.
+    # Also don't read streamer infos when opening files, and don't let class
+    # lookups trigger header parsing.  Neither is needed to inspect keys.
+
+    ROOT.TFile.SetReadaheadSize(0)
+    ROOT.TFile.SetReadStreamerInfo(False)
+    ROOT.gInterpreter.SetClassAutoparsing(False)
+
+    # Declare compiled helper functions.
+
+    ROOT.gInterpreter.Declare(helper_code)
+
+# Default maximum number of worker processes.
+# Grid jobs usually only have one or a few slots on a shared node, and
+# checking files is mostly limited by i/o latency, rather than by cpu.
+
+max_default_jobs = 4
+
+# Return the default number of worker processes.
+
+def default_jobs():
+
+    if hasattr(os, 'sched_getaffinity'):
+        ncpu = len(os.sched_getaffinity(0))
+    else:
+        ncpu = multiprocessing.cpu_count()
+    return max(1, min(max_default_jobs, ncpu))
+
+# Number of file opens that are allowed to be in flight at once (per worker process).
+
+pipeline_depth = 16
+
+# Number of files handed to a worker process at one time.
+
+batch_size = 64
+
+# Number of bytes to read from the start of a remote file when reading the
+# file header and top directory record.
+
+header_read_size = 1024
+
+# Servers for which reading the key list with http range requests failed.
+# Files from these servers are always opened using TFile.
+
+range_failed_servers = set()
+
+# Size of the standard input buffer.
+
+stdin_buffer_size = 1 << 20
+
+# Generator function that yields input file names from a stream.
+# Only the first word of each line is kept.  Blank lines are skipped.
+
+def input_files(stream):
+
+    for line in stream:
+        words = line.split(None, 1)
+        if len(words) > 0:
+            yield words[0]
+
+
+# Quick check of the magic bytes at the start of a local file.
+# Returns False if the file is definitely not a root file, or None if the
+# file can't be read.  Urls are not checked here (always returns True), since
+# for remote files a separate read would cost as much as just opening the file.
+
+def has_root_magic(f):
+
+    if f.find('://') >= 0:
+        return True
+    try:
+        fd = os.open(f, os.O_RDONLY)
+        try:
+            hdr = os.read(fd, 4)
+        finally:
+            os.close(fd)
+    except OSError:
+        return None
+    return hdr == b'root'
+
+
+# Finish opening a file started by TFile.AsyncOpen and check whether it
+# is an artroot file.
+# The open, check, and close are done in compiled code (see
+# artroot_filter::check_file above).
+# Returns 1 (artroot), 0 (not artroot), or -1 (open failed).
+
+def check_file(handle):
+    return int(ROOT.artroot_filter.check_file(handle))
+
+
+# Read a byte range from a remote (http or https) file.
+# Raises an exception if the server doesn't honor the range request.
+
+def read_range(url, first, nbytes):
+
+    req = urlrequest.Request(url, headers={'Range': 'bytes=%d-%d' % (first, first + nbytes - 1)})
+    furl = urlrequest.urlopen(req, timeout=60)
+    try:
+        if furl.getcode() != 206:
+            raise IOError('Range request not supported for %s' % url)
+        data = furl.read(nbytes)
+    finally:
+        furl.close()
+    return data
+
+
+# Class for unpacking big-endian binary data from a buffer, as stored in
+# root files.
+
+class RootBuffer:
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    # Unpack a struct format, and advance the current position.
 
-# Import ROOT module.
-# Globally turn off root warning and error messages.
-# Don't let root see our command line options.
+    def unpack(self, fmt):
+        result = struct.unpack_from('>' + fmt, self.data, self.pos)
+        self.pos += struct.calcsize('>' + fmt)
+        return result
+
+    # Unpack a 32-bit, or if big is true a 64-bit, integer.
+
+    def int(self, big=False):
+        if big:
+            return self.unpack('q')[0]
+        return self.unpack('i')[0]
+
+    # Unpack a TString.
+
+    def string(self):
+        n = self.unpack('B')[0]
+        if n == 255:
+            n = self.int()
+        result = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return result.decode('latin-1')
+
+    # Unpack a TKey header.  Returns (class name, object name).
+
+    def key(self):
+        nbytes, version, objlen, datime, keylen, cycle = self.unpack('ihiIhh')
+        self.int(version > 1000)    # Seek key.
+        self.int(version > 1000)    # Seek parent directory.
+        clsname = self.string()
+        name = self.string()
+        self.string()               # Title.
+        return clsname, name
+
+
+# Read the top directory key list of a remote (http or https) root file
+# using http range requests, without opening the file with TFile.
+# Two requests are made: one for the file header and top directory record,
+# and one for the key list, which is usually near the end of the file.
+#
+# Returns a dictionary {object name: class name}, or None if the key list
+# could not be read this way (e.g. server doesn't support range requests,
+# authentication failure, not a root file, unexpected file layout).
+
+def remote_keys(url):
+
+    server = urlparse(url).netloc
+    if server in range_failed_servers:
+        return None
+    try:
+        data = read_range(url, 0, header_read_size)
+    except Exception:
+        range_failed_servers.add(server)
+        return None
+
+    try:
+        if data[0:4] != b'root':
+            return None
+
+        # File header.
+
+        buf = RootBuffer(data, 4)
+        version = buf.int()
+        begin = buf.int()
+        big = version >= 1000000
+        buf.int(big)                # End.
+        buf.int(big)                # Seek free segments.
+        nbytes_free, nfree, nbytes_name = buf.unpack('iii')
+
+        # Top directory record.
+
+        buf = RootBuffer(data, begin + nbytes_name)
+        dir_version, ctime, mtime, nbytes_keys, dir_nbytes_name = buf.unpack('hIIii')
+        dir_big = dir_version > 1000
+        buf.int(dir_big)            # Seek directory.
+        buf.int(dir_big)            # Seek parent.
+        seek_keys = buf.int(dir_big)
+
+        # Key list.
+
+        buf = RootBuffer(read_range(url, seek_keys, nbytes_keys))
+        buf.key()
+        nkeys = buf.int()
+        result = {}
+        for i in range(nkeys):
+            clsname, name = buf.key()
+            result[name] = clsname
+        return result
+
+    except Exception:
+        return None
+
+
+# Check whether a remote file is an artroot file using its key list read
+# via http range requests (see remote_keys).
+# Returns None if this can't be determined, in which case the file should
+# be opened with TFile.
+
+def check_remote_file(f):
+
+    if not (f.startswith('http://') or f.startswith('https://')):
+        return None
+    keys = remote_keys(f)
+    if keys is None:
+        return None
+    return 'Events' in keys and 'RootFileDB' in keys and \
+        bool(ROOT.artroot_filter.inherits(keys['Events'], 'TTree'))
+
+
+# Return the TFile open option for the specified file.
+# Local files are opened without being registered in the global list of
+# files.  This option is only understood by the local file plugin, so
+# urls are opened with the plain read option.
+
+def open_option(f):
+
+    if f.find('://') >= 0:
+        return 'read'
+    return 'READ_WITHOUT_GLOBALREGISTRATION'
+
+
+# Worker function.
+# Check a batch of files.
+#
+# The argument is a list of (file name, cache key, cached result) tuples,
+# where the cached result is None if the file was not found in the result
+# cache (see below).  The return value is a list of
+# (file name, cache key, is artroot, new result) tuples, in the same order.
+# New result is true for new results that should be cached.  Files that
+# couldn't be read or opened (possibly a transient error) are reported as
+# not artroot, but aren't cached.
+#
+# Files are opened asynchronously, with up to pipeline_depth opens in
+# flight at once, so that the latency of opening remote (xrootd) files
+# overlaps with checking files that have already been opened.
+# For protocols that don't support asynchronous opens, ROOT defers to
+# an ordinary synchronous open when the handle is consumed.
+# Each file is closed as soon as it has been checked, so at most
+# pipeline_depth files are open at any time.
+
+def check_files(batch):
+
+    result = [None] * len(batch)
+    pending = collections.deque()
+    for i in range(len(batch)):
+        f, key, cached = batch[i]
+        if cached != None:
+            result[i] = (f, key, cached, False)
+            continue
+        magic = has_root_magic(f)
+        if not magic:
+            result[i] = (f, key, False, magic == False)
+        else:
+            ok = check_remote_file(f)
+            if ok != None:
+                result[i] = (f, key, ok, True)
+                continue
+            pending.append((i, ROOT.TFile.AsyncOpen(f, open_option(f))))
+            if len(pending) >= pipeline_depth:
+                j, handle = pending.popleft()
+                status = check_file(handle)
+                result[j] = (batch[j][0], batch[j][1], status > 0, status >= 0)
+
+    # Drain remaining opens.
+
+    while len(pending) > 0:
+        j, handle = pending.popleft()
+        status = check_file(handle)
+        result[j] = (batch[j][0], batch[j][1], status > 0, status >= 0)
+
+    # Done.
+
+    return result
+
+
+# Open the persistent result cache (dbm database at the specified path).
+# Returns None if no cache path was specified, or if the cache can't be
+# opened for any reason (e.g. unwritable directory, or the database is
+# locked by another process), in which case every file is checked.
+
+def open_cache(path):
+
+    if path == None:
+        return None
+    try:
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        return dbm.open(path, 'c')
+    except Exception:
+        return None
+
+
+# Return the result cache key for the specified file.
+# Only local files are cached.  The key includes the modification time and
+# size of the file, so that rewritten files are checked again.
+# Returns None for files that can't be cached.
+
+def cache_key(f):
+
+    if f.find('://') >= 0:
+        return None
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return '%s %r %d' % (os.path.realpath(f), st.st_mtime, st.st_size)
+
+
+# Generator function that looks up input files in the result cache.
+# Yields (file name, cache key, cached result) tuples.
+# The cache is not thread safe, so this generator should be consumed in
+# the main thread (not passed to the worker pool directly).
+
+def lookup_cache(files, cache):
+
+    for f in files:
+        key = None
+        cached = None
+        if cache != None:
+            key = cache_key(f)
+            if key != None:
+                try:
+                    cached = (cache[key] == b'1')
+                except KeyError:
+                    pass
+        yield (f, key, cached)
+
+
+# Generator function that groups input entries (tuples whose first element
+# is the file name) into batches (lists) of at most batch_size entries.
+# A new batch is also started whenever the server (url network location)
+# changes, so that each worker process talks to a single server at a time,
+# and can reuse its xrootd connection for all files in the batch.
+# Local files all have an empty network location.
+
+def batches(entries):
+
+    batch = []
+    batch_server = None
+    for entry in entries:
+        server = urlparse(entry[0]).netloc
+        if len(batch) > 0 and (len(batch) >= batch_size or server != batch_server):
+            yield batch
+            batch = []
+        batch.append(entry)
+        batch_server = server
+    if len(batch) > 0:
+        yield batch
 
-myargv = sys.argv
-sys.argv = myargv[0:1]
-if 'TERM' in os.environ:
-    del os.environ['TERM']
-import ROOT
-ROOT.gErrorIgnoreLevel = ROOT.kFatal
-sys.argv = myargv
 
 # Main program.
 
 def main(argv):
 
-    # Loop over stdin lines.
+    # Parse arguments.
 
-    for line in sys.stdin.readlines():
+    cache_path = None
+    jobs = default_jobs()
+    args = argv[1:]
+    while len(args) > 0:
+        if args[0] == '--jobs' and len(args) > 1:
+            jobs = max(1, int(args[1]))
+            del args[0:2]
+        elif args[0] == '--cache' and len(args) > 1:
+            cache_path = args[1]
+            del args[0:2]
+        else:
+            print('Unknown option %s' % args[0], file=sys.stderr)
+            return 1
 
-        # Separate line into words and only keep the first word.
-        # Blanks lines are skipped here.
+    # Open result cache.
 
-        words = line.split()
-        if len(words) > 0:
-            f=words[0]
-
-            # Try to open file as a root file.
-
-            root = ROOT.TFile.Open(f, 'read')
-            if root and root.IsOpen() and not root.IsZombie():
-
-                # File opened successfully.
-                # Loop over this file keys.
-                # To qualify as an artroot file, this file must contain the following objects:
-                # 1.  A TTree called 'Events'
-                # 2.  A TKey called 'RootFileDB'
-
-                has_events = False
-                has_db = False
-                keys = root.GetListOfKeys()
-                for key in keys:
-                    objname = key.GetName()
-                    obj = root.Get(objname)
-                    if objname == 'Events' and obj.InheritsFrom('TTree'):
-                        has_events = True
-                    if objname == 'RootFileDB' and obj.InheritsFrom('TKey'):
-                        has_db = True
-
-                # Is this an artroot file?  Print file name if yes.
-
-                if has_events and has_db:
-                    print(f)
+    cache = open_cache(cache_path)
+
+    # Loop over batches of input files.
+    # Standard input is read through a large buffer, to reduce the number of
+    # read system calls when reading long file lists from a pipe.
+    # If there is a result cache, all input files are looked up in the cache
+    # up front.  Cache reads and writes are only done in this thread.
+    # Batches are checked in parallel by a pool of worker processes, each
+    # of which initializes its own root (this process never imports root).
+    # Results are printed in input order.
+
+    pool = multiprocessing.Pool(jobs, init_root)
+    try:
+        stdin = io.open(sys.stdin.fileno(), 'r', buffering=stdin_buffer_size, closefd=False)
+        entries = lookup_cache(input_files(stdin), cache)
+        if cache != None:
+            entries = list(entries)
+        for result in pool.imap(check_files, batches(entries)):
+
+            # Print artroot files from this batch and remember new results.
+            # Output is written and flushed once per batch.
+
+            lines = []
+            for f, key, ok, new in result:
+                if ok:
+                    lines.append(f + '\n')
+                if new and key != None and cache != None:
+                    cache[key] = ok and b'1' or b'0'
+            if len(lines) > 0:
+                sys.stdout.write(''.join(lines))
+                sys.stdout.flush()
+
+    finally:
+        pool.close()
+        pool.join()
+        if cache != None:
+            cache.close()
 
     # Done.
 
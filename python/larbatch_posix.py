@@ -306,7 +306,8 @@ def copy(src, dest):
     else:
         if debug:
             print('*** Larbatch_posix: Copy %s to %s using posix.' % (src, dest))
-        shutil.copy(src, dest)
+        if not larbatch_utilities.kernel_cp(src, dest):
+            shutil.copy(src, dest)
 
     # Done
 
@@ -330,7 +331,7 @@ def listdir(path):
 
         # Call "ifdh ls".
 
-        contents = larbatch_utilities.ifdh_ls(path, 1)
+        contents = larbatch_utilities.ifdh_ls_iter(path, 1)
 
         # Loop over contents returned by ifdh.
         # Normalize the paths returned by "ifdh ls", which in this context mainly
@@ -448,7 +449,7 @@ def isdir(path):
             npath = os.path.normpath(path)      # Strip trailing '/'
             name = os.path.basename(npath)
             dir = os.path.dirname(npath)
-            lines = larbatch_utilities.ifdh_ll(dir, 1)
+            lines = larbatch_utilities.ifdh_ll_iter(dir, 1)
             for line in lines:
                 words = line.split()
                 if len(words) > 5 and words[-1] == name:
@@ -492,7 +493,7 @@ def stat(path):
         npath = os.path.normpath(path)      # Strip trailing '/'
         name = os.path.basename(npath)
         dir = os.path.dirname(npath)
-        lines = larbatch_utilities.ifdh_ll(dir, 1)
+        lines = larbatch_utilities.ifdh_ll_iter(dir, 1)
         for line in lines:
             words = line.split()
             if len(words) >5 and words[-1] == name:
@@ -599,7 +600,7 @@ def walk(top, topdown=True):
 
         # Retrieve the contents of this directory using ifdh.
 
-        lines = larbatch_utilities.ifdh_ll(top, 1)
+        lines = larbatch_utilities.ifdh_ll_iter(top, 1)
         for line in lines:
             words = line.split()
             if len(words) > 5 and words[-1] != '__pycache__':
@@ -754,15 +755,19 @@ def rmtree(path):
             print('*** Larbatch_posix: Delete directoroy tree %s using ifdh.' % path)
 
         # Delete contents recursively.
+        # Files in this directory are deleted concurrently.
 
-        lines = larbatch_utilities.ifdh_ll(path, 1)
+        files = []
+        lines = larbatch_utilities.ifdh_ll_iter(path, 1)
         for line in lines:
             words = line.split()
             if len(words) > 5:
                 if words[0][0] == 'd':
                     rmtree(os.path.join(path, words[-1]))
                 else:
-                    remove(os.path.join(path, words[-1]))
+                    files.append(os.path.join(path, words[-1]))
+        if len(files) > 0:
+            larbatch_utilities.ifdh_rm(files)
 
         # Directory should be empty when we get to here.
 
@@ -12,30 +12,38 @@
 # functions are equipped with authentication checking, timeouts and
 # other protections.
 #
+# run_ifdh - Run an arbitrary ifdh command (used by the functions below).
 # ifdh_cp - Interface for "ifdh cp."
+# ifdh_cp_batch - Interface for "ifdh cp" with multiple copies per invocation.
 # ifdh_ls - Interface for "ifdh ls."
+# ifdh_ls_iter - Interface for "ifdh ls" (iterator over lines).
 # ifdh_ll - Interface for "ifdh ll."
+# ifdh_ll_iter - Interface for "ifdh ll" (iterator over lines).
 # ifdh_mkdir - Interface for "ifdh mkdir."
 # ifdh_mkdir_p - Interface for "ifdh mkdir_p."
 # ifdh_rmdir - Interface for "ifdh rmdir."
 # ifdh_mv - Interface for "ifdh mv."
 # ifdh_rm - Interface for "ifdh rm."
 # ifdh_chmod - Interface for "ifdh chmod."
+# ifdh_map - Apply an ifdh function to many paths concurrently.
 #
 # The following functions are provided as interfaces to posix tools
 # with additional protections or timeouts.
 #
 # posix_cp - Copy file with timeout.
+# kernel_cp - Copy regular file using copy_file_range or sendfile.
 #
 # Authentication functions.
 #
 # test_ticket - Raise an exception of user does not have a valid kerberos ticket.
+# check_krb5_ticket - Check kerberos credentials cache using libkrb5.
 # get_kca - Get a kca certificate.
 # get_proxy - Get a grid proxy.
 # get_token - Get a bearer token by calling htgettoken.
 # test_kca - Get a kca certificate if necessary.
 # test_proxy - Get a grid proxy if necessary.
 # test_token - Get bearer token if necessary.
+# token_lifetime - Remaining lifetime of bearer token.
 # get_experiment - Get standard experiment name.
 # get_user - Get authenticated user.
 # get_prouser - Get production user.
@@ -53,6 +61,9 @@
 #
 # get_ups_products - Top level ups products.
 # get_setup_script_path - Full path of experiment setup script.
+# run_with_timeout - Run a command in a subprocess with a timeout.
+# ifdh_env - Environment for ifdh subprocesses.
+# iter_lines - Generate lines of a string without materializing a list.
 # wait_for_subprocess - For use with subprocesses with timeouts.
 # dcache_server - Return dCache server.
 # dcache_path - Convert dCache local path to path on server.
@@ -72,15 +83,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os
+import base64
+import ctypes
+import errno
+import json
+import signal
 import socket
 import stat
 import subprocess
+import time
 import getpass
-import threading
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+import concurrent.futures
 from project_modules.ifdherror import IFDHError
 
 # Global variables.
@@ -90,488 +103,382 @@ kca_ok = False
 proxy_ok = False
 token_ok = False
 kca_user = ''
+experiment_name = ''
+user_role = ''
 jobsub_ok = False
+ifdh_pool = None
 
-# Copy file using ifdh, with timeout.
-
-def ifdh_cp(source, destination):
-
-    # Get proxy.
-
-    test_proxy()
-
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
+# Generate the lines of a string (without line terminators).
+# Equivalent to iterating over s.splitlines() for ifdh output, but without
+# building the whole list up front.
 
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
-
-    # Do copy.
-
-    cmd = ['ifdh', 'cp', source, destination]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=31000000)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
+def iter_lines(s):
+    start = 0
+    n = len(s)
+    while start < n:
+        end = s.find('\n', start)
+        if end < 0:
+            end = n
+        yield s[start:end].rstrip('\r')
+        start = end + 1
 
-    # Restore environment variables.
 
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
+# Run an ifdh command, with timeout.
+# Arguments are the ifdh command line arguments (not including "ifdh"),
+# the timeout in seconds, and optionally the environment to use (default
+# ifdh_env()).
+# Raise IFDHError if the command fails.  Return value is standard output.
 
-
-# Ifdh ls, with timeout.
-# Return value is list of lines returned by "ifdh ls" command.
-
-def ifdh_ls(path, depth):
+def run_ifdh(args, timeout, env=None):
 
     # Get proxy.
 
     test_proxy()
 
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
-
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
-
-    # Do listing.
-
-    cmd = ['ifdh', 'ls', path, '%d' % depth]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Run command.
 
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=600)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
+    if env == None:
+        env = ifdh_env()
+    cmd = ['ifdh'] + args
+    rc, jobout, joberr = run_with_timeout(cmd, timeout, env)
     if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
         raise IFDHError(cmd, rc, jobout, joberr)
 
-    # Restore environment variables.
-
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
-
     # Done.
 
-    return jobout.splitlines()
+    return jobout
 
 
-# Ifdh ll, with timeout.
-# Return value is list of lines returned by "ifdh ls" command.
-
-def ifdh_ll(path, depth):
-
-    # Get proxy.
+# Copy file using ifdh, with timeout.
 
-    test_proxy()
+def ifdh_cp(source, destination):
+    run_ifdh(['cp', source, destination], 31000000)
 
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
 
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
+# Copy multiple files using ifdh, with timeout.
+# Argument is a list of (source, destination) pairs.
+# Copies are done by as few "ifdh cp" invocations as possible, using the
+# ifdh multiple copy syntax "ifdh cp src1 dest1 ; src2 dest2 ; ..." (each ";"
+# is a separate argument).  The command line length of each invocation is
+# limited to ifdh_max_arg_length characters.
 
-    # Do listing.
+ifdh_max_arg_length = 100000
 
-    cmd = ['ifdh', 'll', path, '%d' % depth]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def ifdh_cp_batch(copies):
 
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=60)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
+    # Group copies into command lines.
 
-    # Restore environment variables.
+    cmds = []
+    cmd = []
+    length = 0
+    for source, destination in copies:
+        n = len(source) + len(destination) + 4
+        if len(cmd) > 0 and length + n > ifdh_max_arg_length:
+            cmds.append(cmd)
+            cmd = []
+            length = 0
+        if len(cmd) > 0:
+            cmd.append(';')
+        cmd.extend([source, destination])
+        length += n
+    if len(cmd) > 0:
+        cmds.append(cmd)
+    if len(cmds) == 0:
+        return
 
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
+    # Do copies.
 
-    # Done.
+    env = ifdh_env()
+    for args in cmds:
+        run_ifdh(['cp'] + args, 31000000, env)
 
-    return jobout.splitlines()
 
+# Ifdh ls, with timeout.
+# Return value is list of lines returned by "ifdh ls" command.
 
-# Ifdh mkdir, with timeout.
+def ifdh_ls(path, depth):
+    return run_ifdh(['ls', path, str(depth)], 600).splitlines()
 
-def ifdh_mkdir(path):
 
-    # Get proxy.
+# Like ifdh_ls, but return an iterator over the lines returned by "ifdh ls".
+# The command is run (and any error raised) when this function is called,
+# but the output is split into lines as the iterator is consumed.
 
-    test_proxy()
+def ifdh_ls_iter(path, depth):
+    return iter_lines(run_ifdh(['ls', path, str(depth)], 600))
 
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
 
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
+# Ifdh ll, with timeout.
+# Return value is list of lines returned by "ifdh ll" command.
 
-    # Do mkdir.
+def ifdh_ll(path, depth):
+    return run_ifdh(['ll', path, str(depth)], 60).splitlines()
 
-    cmd = ['ifdh', 'mkdir', path]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=60)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
+# Like ifdh_ll, but return an iterator over the lines returned by "ifdh ll".
+# The command is run (and any error raised) when this function is called,
+# but the output is split into lines as the iterator is consumed.
 
-    # Restore environment variables.
+def ifdh_ll_iter(path, depth):
+    return iter_lines(run_ifdh(['ll', path, str(depth)], 60))
 
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
 
-    # Done.
+# Ifdh mkdir, with timeout.
 
-    return
+def ifdh_mkdir(path):
+    run_ifdh(['mkdir', path], 60)
 
 
 # Ifdh mkdir_p, with timeout.
+# Argument may also be a list of paths (done concurrently using ifdh_map).
 
 def ifdh_mkdir_p(path):
-
-    # Get proxy.
-
-    test_proxy()
-
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
-
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
-
-    # Do mkdir_p.
-
-    cmd = ['ifdh', 'mkdir_p', path]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=600)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
-
-    # Restore environment variables.
-
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
-
-    # Done.
-
-    return
+    if isinstance(path, (list, tuple)):
+        ifdh_map(ifdh_mkdir_p, path)
+        return
+    run_ifdh(['mkdir_p', path], 600)
 
 
 # Ifdh rmdir, with timeout.
 
 def ifdh_rmdir(path):
-
-    # Get proxy.
-
-    test_proxy()
-
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
-
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
-
-    # Do rmdir.
-
-    cmd = ['ifdh', 'rmdir', path]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=60)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
-
-    # Restore environment variables.
-
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
-
-    # Done.
-
-    return
+    run_ifdh(['rmdir', path], 60)
 
 
 # Ifdh chmod, with timeout.
+# Failure is not fatal (only a warning is printed).
+# Argument may also be a list of paths (done concurrently using ifdh_map).
 
 def ifdh_chmod(path, mode):
-
-    # Get proxy.
-
-    test_proxy()
-
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
-
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
-
-    # Do chmod.
-
-    cmd = ['ifdh', 'chmod', '%o' % mode, path]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=60)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
+    if isinstance(path, (list, tuple)):
+        ifdh_map(ifdh_chmod, path, mode)
+        return
+    try:
+        run_ifdh(['chmod', format(mode, 'o'), path], 60)
+    except IFDHError:
         print('Warning: ifdh chmod failed for path %s' % path)
 
-    # Restore environment variables.
-
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
-
-    # Done.
-
-    return
-
 
 # Ifdh mv, with timeout.
 
 def ifdh_mv(src, dest):
+    run_ifdh(['mv', src, dest], 60)
 
-    # Get proxy.
-
-    test_proxy()
-
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
 
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
+# Ifdh rm, with timeout.
+# Argument may also be a list of paths (done concurrently using ifdh_map).
 
-    # Do rename.
+def ifdh_rm(path):
+    if isinstance(path, (list, tuple)):
+        ifdh_map(ifdh_rm, path)
+        return
+    run_ifdh(['rm', path], 60)
 
-    cmd = ['ifdh', 'mv', src, dest]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=60)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
+# Apply an ifdh function (e.g. ifdh_rm or ifdh_ls) to each of a list of
+# paths, using a persistent pool of threads, so that independent ifdh
+# subprocesses run concurrently.
+# Any extra arguments are passed to each call, after the path.
+# Return a list of results, in the same order as the paths.
+# If any call raises an exception, the first one (in path order) is reraised.
 
-    # Restore environment variables.
+def ifdh_map(op, paths, *args):
 
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
+    global ifdh_pool
 
-    # Done.
+    # Get proxy (once, before starting any threads).
 
-    return
+    test_proxy()
 
+    # Create the thread pool on first use.
 
-# Ifdh rm, with timeout.
+    if ifdh_pool == None:
+        ifdh_pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1)))
 
-def ifdh_rm(path):
+    # Do calls.
 
-    # Get proxy.
+    futures = [ifdh_pool.submit(op, path, *args) for path in paths]
+    return [future.result() for future in futures]
 
-    test_proxy()
 
-    # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-    # are not defined (they confuse ifdh, or rather the underlying tools).
+# Filesystem types that are known to be local (can't hang like network
+# filesystems, which include nfs, afs, and fuse filesystems like eos and cvmfs).
 
-    save_vars = {}
-    for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-        if var in os.environ:
-            save_vars[var] = os.environ[var]
-            del os.environ[var]
+local_fs_types = ('ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'zfs', 'tmpfs', 'overlay')
 
-    # Do delete.
+# Return True if the specified path (which may not exist) is on a local
+# filesystem, based on the longest matching mount point in /proc/mounts.
+# The path is not resolved (resolving symbolic links would access the
+# filesystem).  Return False if this can't be determined.
 
-    cmd = ['ifdh', 'rm', path]
-    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def is_local_path(path):
+    path = os.path.abspath(path)
+    fstype = None
+    mount_len = -1
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                words = line.split()
+                if len(words) < 3:
+                    continue
+                mount = words[1]
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and \
+                   len(mount) > mount_len:
+                    fstype = words[2]
+                    mount_len = len(mount)
+    except (IOError, OSError):
+        return False
+    return fstype in local_fs_types
+
+
+# Copy a regular file in this process using the copy_file_range system call
+# (or sendfile, if copy_file_range isn't available or isn't supported between
+# these files), without starting a subprocess.
+# Only files on local filesystems are copied this way, since there is no
+# timeout protection against hung network filesystems.
+# Like cp, the destination may be a directory.
+# Return True if the copy succeeded, False if the file could not be copied
+# this way (in which case the caller should fall back to cp).
+
+def kernel_cp(source, destination):
+
+    if not is_local_path(source) or not is_local_path(destination):
+        return False
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+    try:
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            src_stat = os.fstat(src_fd)
+            if not stat.S_ISREG(src_stat.st_mode):
+                return False
 
-    q = queue.Queue()
-    thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-    thread.start()
-    thread.join(timeout=60)
-    if thread.is_alive():
-        print('Terminating subprocess.')
-        jobinfo.terminate()
-        thread.join()
-    rc = q.get()
-    jobout = convert_str(q.get())
-    joberr = convert_str(q.get())
-    if rc != 0:
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
-        raise IFDHError(cmd, rc, jobout, joberr)
+            # Don't truncate the source, if the destination is the same file
+            # (or a hard link to it).  Let the fallback copy report the error.
 
-    # Restore environment variables.
+            created = False
+            try:
+                dest_stat = os.stat(destination)
+                if (dest_stat.st_dev, dest_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+                    return False
+            except OSError:
+                created = True
+            dest_fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              stat.S_IMODE(src_stat.st_mode))
+            try:
 
-    for var in list(save_vars.keys()):
-        os.environ[var] = save_vars[var]
+                # Set the mode of a newly created file (not affected by umask),
+                # but leave the mode of an existing file alone.
+
+                if created:
+                    os.fchmod(dest_fd, stat.S_IMODE(src_stat.st_mode))
+                use_copy_file_range = hasattr(os, 'copy_file_range')
+                while True:
+                    n = 0
+                    if use_copy_file_range:
+                        try:
+                            n = os.copy_file_range(src_fd, dest_fd, 1 << 30)
+                        except OSError as e:
+                            if e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                           errno.EOPNOTSUPP):
+                                use_copy_file_range = False
+                            else:
+                                raise
+                    if not use_copy_file_range:
+                        n = os.sendfile(dest_fd, src_fd, None, 1 << 30)
+                    if n == 0:
+                        break
+            finally:
+                os.close(dest_fd)
+        finally:
+            os.close(src_fd)
+    except (OSError, AttributeError):
+        return False
 
     # Done.
 
-    return
+    return True
 
 
 # Posix copy with timeout.
+# Copies between local filesystems are done in this process using kernel_cp,
+# if possible.  Other copies (dCache or other network filesystems), where
+# the file system may hang, are done by cp in a watchdog subprocess.
 
 def posix_cp(source, destination):
 
+    if not source.startswith('/pnfs/') and not destination.startswith('/pnfs/'):
+        if kernel_cp(source, destination):
+            return
+
     cmd = ['cp', source, destination]
 
-    # Fork buffer process.
+    # Launch cp subprocess in its own session (process group), so that the
+    # whole group can be killed on timeout.
 
-    buffer_pid = os.fork()
-    if buffer_pid == 0:
+    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=True)
+    try:
+        jobout, joberr = jobinfo.communicate(timeout=600)
+
+    except subprocess.TimeoutExpired:
 
-        # In child process.
-        # Launch cp subprocess.
+        # Subprocess did not finish (may be hanging and unkillable).
+        # Try to kill the subprocess, but don't wait for it.
+        # Unkillable process will become detached.
 
-        jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        print('Terminating subprocess.')
+        try:
+            os.killpg(jobinfo.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        jobinfo.stdout.close()
+        jobinfo.stderr.close()
+        raise IFDHError(cmd, 1, '', '')
 
-        q = queue.Queue()
-        thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-        thread.start()
-        thread.join(timeout=600)
-        if thread.is_alive():
+    # Subprocess finished.
+    # Return code is negative if the subprocess was killed by a signal.
 
-            # Subprocess did not finish (may be hanging and unkillable).
-            # Try to kill the subprocess and exit process.
-            # Unkillable process will become detached.
+    rc = jobinfo.returncode
+    if rc != 0:
+        raise IFDHError(cmd, rc, convert_str(jobout), convert_str(joberr))
 
-            print('Terminating subprocess.')
-            jobinfo.kill()
-            os._exit(1)
+    # Done.
 
-        else:
+    return
 
-            # Subprocess finished normally.
 
-            rc = q.get()
-            jobout = convert_str(q.get())
-            joberr = convert_str(q.get())
-            os._exit(rc)
+# Run a command in a subprocess, with a timeout (in seconds).
+# Optional argument env is the environment of the subprocess (default is
+# to inherit the environment of this process).
+# Return a 3-tuple containing the return code, standard output, and
+# standard error (output converted to str).
+# If the timeout expires, the subprocess is terminated.
 
-    else:
+def run_with_timeout(cmd, timeout, env=None):
+    jobinfo = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    try:
+        jobout, joberr = jobinfo.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print('Terminating subprocess.')
+        jobinfo.terminate()
+        jobout, joberr = jobinfo.communicate()
+    return jobinfo.returncode, convert_str(jobout), convert_str(joberr)
 
-        # In parent process.
-        # Wait for buffer subprocess to finish.
 
-        buffer_result = os.waitpid(buffer_pid, 0)
-        rc = buffer_result[1]/256
-        if rc != 0:
-            raise IFDHError(cmd, rc, '', '')
+# Return the environment to use for ifdh subprocesses.
+# This is a copy of the current environment in which environment variables
+# X509_USER_CERT and X509_USER_KEY are not defined (they confuse ifdh, or
+# rather the underlying tools).  The environment of this process is not
+# modified.
 
-    # Done.
+ifdh_unset_vars = ('X509_USER_CERT', 'X509_USER_KEY')
 
-    return
+def ifdh_env():
+    env = os.environ.copy()
+    for var in ifdh_unset_vars:
+        env.pop(var, None)
+    return env
 
 
 # Function to wait for a subprocess to finish and fetch return code,
@@ -595,13 +502,85 @@ def wait_for_subprocess(jobinfo, q, input=None):
     return
 
 
+# Credentials structure from the MIT kerberos C api (krb5.h).
+
+class krb5_creds(ctypes.Structure):
+    _fields_ = [('magic', ctypes.c_int32),
+                ('client', ctypes.c_void_p),
+                ('server', ctypes.c_void_p),
+                ('keyblock_magic', ctypes.c_int32),
+                ('keyblock_enctype', ctypes.c_int32),
+                ('keyblock_length', ctypes.c_uint),
+                ('keyblock_contents', ctypes.c_void_p),
+                ('authtime', ctypes.c_int32),
+                ('starttime', ctypes.c_int32),
+                ('endtime', ctypes.c_int32),
+                ('renew_till', ctypes.c_int32),
+                ('is_skey', ctypes.c_uint),
+                ('ticket_flags', ctypes.c_int32),
+                ('addresses', ctypes.c_void_p),
+                ('ticket_magic', ctypes.c_int32),
+                ('ticket_length', ctypes.c_uint),
+                ('ticket_data', ctypes.c_void_p),
+                ('second_ticket_magic', ctypes.c_int32),
+                ('second_ticket_length', ctypes.c_uint),
+                ('second_ticket_data', ctypes.c_void_p),
+                ('authdata', ctypes.c_void_p)]
+
+
+# Check the default kerberos credentials cache for an unexpired ticket
+# granting ticket using libkrb5 directly (same test as "klist -s").
+# Return True or False, or None if libkrb5 can not be used.
+
+def check_krb5_ticket():
+
+    try:
+        krb5 = ctypes.CDLL('libkrb5.so.3')
+    except OSError:
+        return None
+
+    context = ctypes.c_void_p()
+    if krb5.krb5_init_context(ctypes.byref(context)) != 0:
+        return None
+    result = False
+    try:
+        ccache = ctypes.c_void_p()
+        if krb5.krb5_cc_default(context, ctypes.byref(ccache)) != 0:
+            return False
+        try:
+            cursor = ctypes.c_void_p()
+            if krb5.krb5_cc_start_seq_get(context, ccache, ctypes.byref(cursor)) != 0:
+                return False
+            now = time.time()
+            creds = krb5_creds()
+            while not result and \
+                  krb5.krb5_cc_next_cred(context, ccache, ctypes.byref(cursor),
+                                         ctypes.byref(creds)) == 0:
+                name = ctypes.c_char_p()
+                if krb5.krb5_unparse_name(context, ctypes.c_void_p(creds.server),
+                                          ctypes.byref(name)) == 0:
+                    if name.value.startswith(b'krbtgt/') and creds.endtime > now:
+                        result = True
+                    krb5.krb5_free_unparsed_name(context, name)
+                krb5.krb5_free_cred_contents(context, ctypes.byref(creds))
+            krb5.krb5_cc_end_seq_get(context, ccache, ctypes.byref(cursor))
+        finally:
+            krb5.krb5_cc_close(context, ccache)
+    finally:
+        krb5.krb5_free_context(context)
+    return result
+
+
 # Test whether user has a valid kerberos ticket.  Raise exception if no.
+# Use libkrb5 if possible, otherwise "klist -s".
 
 def test_ticket():
     global ticket_ok
     if not ticket_ok:
-        ok = subprocess.call(['klist', '-s'], stdout=-1, stderr=-1)
-        if ok != 0:
+        ok = check_krb5_ticket()
+        if ok == None:
+            ok = subprocess.call(['klist', '-s'], stdout=-1, stderr=-1) == 0
+        if not ok:
             raise RuntimeError('Please get a kerberos ticket.')
         ticket_ok = True
     return ticket_ok
@@ -793,19 +772,62 @@ def test_proxy():
     return proxy_ok
 
 
+# Return the remaining lifetime (in seconds) of the current bearer token.
+# The token is found using the standard (WLCG) bearer token discovery
+# rules: environment variable $BEARER_TOKEN, file $BEARER_TOKEN_FILE,
+# file $XDG_RUNTIME_DIR/bt_u<uid>, or file /tmp/bt_u<uid>.
+# The lifetime is calculated from the "exp" claim of the token, which is
+# decoded here without contacting any server and without verifying the
+# token signature.
+# Return 0 if there is no token, or if the token can't be decoded.
+
+def token_lifetime():
+
+    try:
+
+        # Find token.
+
+        token = os.environ.get('BEARER_TOKEN', '')
+        if token == '':
+            token_file = os.environ.get('BEARER_TOKEN_FILE', '')
+            if token_file == '':
+                token_dir = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+                token_file = os.path.join(token_dir, 'bt_u%d' % os.getuid())
+                if not os.path.exists(token_file):
+                    token_file = '/tmp/bt_u%d' % os.getuid()
+            with open(token_file) as f:
+                token = f.read()
+        token = token.strip()
+
+        # Decode payload (second base64url-encoded section).
+
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(convert_str(base64.urlsafe_b64decode(payload)))
+        return max(0, int(claims['exp'] - time.time()))
+
+    except:
+        return 0
+
+
 # Test whether user has a valid bearer token.  If not, try to get a new one.
 
 def test_token():
     global token_ok
     if not token_ok:
 
+        # First check the expiration time of the token file directly.
+
+        token_ok = token_lifetime() > 300
+
         # Try running httokendecode.
 
-        try:
-            subprocess.check_call(['httokendecode'], stdout=-1, stderr=-1)
-            token_ok = True
-        except:
-            token_ok = False
+        if not token_ok:
+            try:
+                subprocess.check_call(['httokendecode'], stdout=-1, stderr=-1)
+                token_ok = True
+            except:
+                token_ok = False
 
         if not token_ok:
             get_token()
@@ -864,6 +886,7 @@ def dcache_server():
 def dcache_path(path):
     if path.startswith('/pnfs/') and not path.startswith('/pnfs/fnal.gov/usr/'):
         return '/pnfs/fnal.gov/usr/' + path[6:]
+    return path
 
 
 # Return xrootd server and port.
@@ -900,73 +923,53 @@ def nfs_server():
     return '%sgpvm01.fnal.gov' % os.environ['EXPERIMENT']
 
 
-# Parse the ten-character file mode string as returned by "ls -l"
-# and return mode bit masek.
+# Mode bits corresponding to each character of a ten-character file mode
+# string, indexed by position, then by character.
 
-def parse_mode(mode_str):
-
-    mode = 0
+mode_bits = (
 
     # File type.
 
-    if mode_str[0] == 'b':
-        mode += stat.S_IFBLK
-    elif mode_str[0] == 'c':
-        mode += stat.S_IFCHR
-    elif mode_str[0] == 'd':
-        mode += stat.S_IFDIR
-    elif mode_str[0] == 'l':
-        mode += stat.S_IFLNK
-    elif mode_str[0] == 'p':
-        mode += stat.S_IFIFO
-    elif mode_str[0] == 's':
-        mode += stat.S_IFSOCK
-    elif mode_str[0] == '-':
-        mode += stat.S_IFREG
-
-    # File permissions.
+    {'b': stat.S_IFBLK,
+     'c': stat.S_IFCHR,
+     'd': stat.S_IFDIR,
+     'l': stat.S_IFLNK,
+     'p': stat.S_IFIFO,
+     's': stat.S_IFSOCK,
+     '-': stat.S_IFREG},
 
     # User triad (includes setuid).
 
-    if mode_str[1] == 'r':
-        mode += stat.S_IRUSR
-    if mode_str[2] == 'w':
-        mode += stat.S_IWUSR
-    if mode_str[3] == 'x':
-        mode += stat.S_IXUSR
-    elif mode_str[3] == 's':
-        mode += stat.S_ISUID
-        mode += stat.S_IXUSR
-    elif mode_str[3] == 'S':
-        mode += stat.S_ISUID
+    {'r': stat.S_IRUSR},
+    {'w': stat.S_IWUSR},
+    {'x': stat.S_IXUSR,
+     's': stat.S_ISUID | stat.S_IXUSR,
+     'S': stat.S_ISUID},
 
     # Group triad (includes setgid).
 
-    if mode_str[4] == 'r':
-        mode += stat.S_IRGRP
-    if mode_str[5] == 'w':
-        mode += stat.S_IWGRP
-    if mode_str[6] == 'x':
-        mode += stat.S_IXGRP
-    elif mode_str[6] == 's':
-        mode += stat.S_ISGID
-        mode += stat.S_IXGRP
-    elif mode_str[6] == 'S':
-        mode += stat.S_ISGID
+    {'r': stat.S_IRGRP},
+    {'w': stat.S_IWGRP},
+    {'x': stat.S_IXGRP,
+     's': stat.S_ISGID | stat.S_IXGRP,
+     'S': stat.S_ISGID},
 
     # World triad (includes sticky bit).
 
-    if mode_str[7] == 'r':
-        mode += stat.S_IROTH
-    if mode_str[8] == 'w':
-        mode += stat.S_IWOTH
-    if mode_str[9] == 'x':
-        mode += stat.S_IXOTH
-    elif mode_str[9] == 't':
-        mode += stat.S_ISVTX
-        mode += stat.S_IXOTH
-    elif mode_str[9] == 'T':
-        mode += stat.S_ISVTX
+    {'r': stat.S_IROTH},
+    {'w': stat.S_IWOTH},
+    {'x': stat.S_IXOTH,
+     't': stat.S_ISVTX | stat.S_IXOTH,
+     'T': stat.S_ISVTX})
+
+# Parse the ten-character file mode string as returned by "ls -l"
+# and return mode bit masek.
+
+def parse_mode(mode_str):
+
+    mode = 0
+    for bits, c in zip(mode_bits, mode_str):
+        mode |= bits.get(c, 0)
 
     # Done
 
@@ -985,6 +988,12 @@ def parse_mode(mode_str):
 
 def get_experiment():
 
+    # See if we have a cached value for experiment.
+
+    global experiment_name
+    if experiment_name != '':
+        return experiment_name
+
     exp = ''
     for ev in ('EXPERIMENT', 'SAM_EXPERIMENT'):
         if ev in os.environ:
@@ -1000,6 +1009,7 @@ def get_experiment():
     if not exp:
         raise RuntimeError('Unable to determine experiment.')
 
+    experiment_name = exp
     return exp
 
 
@@ -1007,6 +1017,12 @@ def get_experiment():
 
 def get_role():
 
+    # See if we have a cached value for role.
+
+    global user_role
+    if user_role != '':
+        return user_role
+
     # If environment variable ROLE is defined, use that.  Otherwise, make
     # an educated guess based on user name.
 
@@ -1025,6 +1041,7 @@ def get_role():
         if user == prouser:
             result = 'Production'
 
+    user_role = result
     return result
 
 
@@ -1123,7 +1140,8 @@ def get_user():
     # Return production user name if Role is Production
 
     if get_role() == 'Production':
-        return get_prouser()
+        kca_user = get_prouser()
+        return kca_user
 
     else:
 
@@ -1180,6 +1198,7 @@ def get_user():
         # Done (maybe).
 
         if cn != '':
+            kca_user = cn
             return cn
 
     # Something went wrong...
@@ -1195,13 +1214,22 @@ def get_ppid(pid):
 
     result = 0
 
+    # Read the whole (small) status file in one go, and find the PPid field.
+
     statfname = '/proc/%d/status' % pid
-    statf = open(statfname)
-    for line in statf.readlines():
-        if line.startswith('PPid:'):
-            words = line.split()
-            if len(words) >= 2 and words[1].isdigit():
-                result = int(words[1])
+    try:
+        with open(statfname, 'rb') as statf:
+            data = statf.read()
+    except (IOError, OSError):
+        return 0
+    i = data.find(b'\nPPid:')
+    if i >= 0:
+        j = data.find(b'\n', i + 6)
+        if j < 0:
+            j = len(data)
+        value = data[i + 6:j].strip()
+        if value.isdigit():
+            result = int(value)
 
     # Done.
 
@@ -1236,23 +1264,33 @@ def check_running(xmlname, stagename):
         ignore_pids.add(pid)
         pid = get_ppid(pid)
 
+    # Command line arguments are compared as bytes.
+
+    xmlbytes = convert_bytes(xmlname)
+    stagebytes = convert_bytes(stagename)
+
     # Look over pids in /proc.
 
-    for pid in os.listdir('/proc'):
+    my_uid = os.getuid()
+    for entry in os.scandir('/proc'):
+        pid = entry.name
         if pid.isdigit() and int(pid) not in ignore_pids:
-            procfile = os.path.join('/proc', pid)
             try:
-                pstat = os.stat(procfile)
+                pstat = entry.stat()
 
                 # Only look at processes that match this process uid.
 
-                if pstat.st_uid == os.getuid():
+                if pstat.st_uid == my_uid:
 
                     # Get command line.
+                    # Quickly reject processes that aren't running project.py.
 
-                    cmdfile = os.path.join('/proc', pid, 'cmdline')
-                    cmd = open(cmdfile).read()
-                    words = cmd.split('\0')
+                    cmdfile = '%s/cmdline' % entry.path
+                    with open(cmdfile, 'rb') as f:
+                        cmd = f.read()
+                    if cmd.find(b'project.py') < 0:
+                        continue
+                    words = cmd.split(b'\0')
 
                     # Check options.
 
@@ -1268,14 +1306,14 @@ def check_running(xmlname, stagename):
 
                         # Check command.
 
-                        if word.endswith('project.py'):
+                        if word.endswith(b'project.py'):
                             project = 1
 
                         # Check arguments.
 
-                        if xml == 1 and word == xmlname:
+                        if xml == 1 and word == xmlbytes:
                             xmlmatch = 1
-                        elif stage == 1 and word == stagename:
+                        elif stage == 1 and word == stagebytes:
                             stagematch = 1
 
                         xml = 0
@@ -1283,13 +1321,13 @@ def check_running(xmlname, stagename):
 
                         # Check options.
 
-                        if word == '--xml':
+                        if word == b'--xml':
                             xml = 1
-                        elif word == '--stage':
+                        elif word == b'--stage':
                             stage = 1
-                        elif word == '--submit':
+                        elif word == b'--submit':
                             submit = 1
-                        elif word == '--makeup':
+                        elif word == b'--makeup':
                             makeup = 1
 
                     if project != 0 and submit+makeup != 0 and xmlmatch != 0 and stagematch != 0:
@@ -1309,36 +1347,21 @@ def check_running(xmlname, stagename):
 
 def convert_str(s):
 
-    result = ''
-
-    if type(s) == type(''):
-
-        # Already a default str.
-        # Just return the original.
-
-        result = s
-
-    elif type(s) == type(u''):
+    # Already a default str (the common case).
+    # Just return the original.
 
-        # Unicode and not str.
-        # Convert to bytes.
+    if isinstance(s, str):
+        return s
 
-        result = s.encode()
+    # Bytes and not str.
+    # Convert to unicode.
 
-    elif type(s) == type(b''):
+    if isinstance(s, bytes):
+        return s.decode()
 
-        # Bytes and not str.
-        # Convert to unicode.
+    # Anything else (including python 2 unicode), use standard str conversion.
 
-        result = s.decode()
-
-    else:
-
-        # Last resort, use standard str conversion.
-
-        result = str(s)
-
-    return result
+    return str(s)
 
 
 # Convert bytes or unicode string to bytes.
@@ -1346,28 +1369,20 @@ def convert_str(s):
 
 def convert_bytes(s):
 
-    result = ''
-
-    if type(s) == type(b''):
-
-        # Already bytes.
-        # Return the original.
+    # Already bytes.
+    # Return the original.
 
-        result = s
+    if isinstance(s, bytes):
+        return s
 
-    elif type(s) == type(u''):
+    # Unicode to bytes.
 
-        # Unicode to bytes.
+    if isinstance(s, type(u'')):
+        return s.encode()
 
-        result = s.encode()
-
-    else:
+    # Anything else, just return the original.
 
-        # Anything else, just return the original.
-
-        result = s
-
-    return result
+    return s
 
 
 # Import experiment-specific utilities.  In this imported module, one can
@@ -13,29 +13,22 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, stat, time, types
-try:
-    import urllib.request as urlrequest
-except ImportError:
-    import urllib as urlrequest
 import datetime
+import re
+import itertools
+import ctypes
+import select
+import atexit
+import pickle
+import concurrent.futures
 import socket
-import subprocess
 import shutil
-import threading
-try:
-    import queue
-except ImportError:
-    import Queue as queue
-import uuid
-import samweb_cli
-from project_modules.ifdherror import IFDHError
 import larbatch_posix
 import larbatch_utilities
 from larbatch_utilities import get_experiment, get_user, get_role, get_prouser
-from larbatch_utilities import test_ticket, test_kca, test_proxy, test_token, get_kca, get_proxy, get_token
+from larbatch_utilities import test_ticket, test_kca, test_token, get_kca, get_proxy, get_token
 from larbatch_utilities import dimensions
 from larbatch_utilities import dimensions_datastream
-from larbatch_utilities import wait_for_subprocess
 from larbatch_utilities import get_bluearc_server
 from larbatch_utilities import get_dcache_server
 from larbatch_utilities import get_dropbox
@@ -44,11 +37,18 @@ from larbatch_utilities import get_ups_products
 from larbatch_utilities import get_setup_script_path
 from larbatch_utilities import check_running
 from larbatch_utilities import convert_str
+from larbatch_utilities import convert_bytes
 
 # Global variables.
 
 samweb_obj = None       # Initialized SAMWebClient object
-samcache = {}           # Sam query cache (samcache[dimension] = set(...)).
+samcache = {}           # Sam query cache (samcache[dimension] = frozenset(...)).
+samcache_time = {}      # Time of sam query (samcache_time[dimension] = time.time()).
+samcache_loaded = False # Has persistent sam cache been loaded?
+defcache = {}           # Existing definitions (defcache[defname] = time last seen).
+defcache_ttl = 60.      # How long (seconds) to trust defcache entries.
+prjstem_cache = {}      # Project name stems (prjstem_cache[defname] = stem).
+singularity_cache = {}  # Singularity images (singularity_cache[(cwd, name)] = path).
 token_auth = False      # Token flag.
 
 
@@ -108,36 +108,76 @@ def use_proxy_auth():
 
 
 # Like os.path.isdir, but faster by avoiding unnecessary i/o.
+# Paths ending in any of the following extensions are assumed not to be directories.
+
+non_dir_extensions = ('.list', '.root', '.txt', '.fcl', '.out', '.err', '.sh', '.stat')
 
 def fast_isdir(path):
-    result = False
-    if path[-5:] != '.list' and \
-            path[-5:] != '.root' and \
-            path[-4:] != '.txt' and \
-            path[-4:] != '.fcl' and \
-            path[-4:] != '.out' and \
-            path[-4:] != '.err' and \
-            path[-3:] != '.sh' and \
-            path[-5:] != '.stat' and \
-            larbatch_posix.isdir(path):
-        result = True
-    return result
+    return not path.endswith(non_dir_extensions) and larbatch_posix.isdir(path)
 
-# Wait for file to appear on local filesystem.
+# Return an inotify file descriptor that watches the specified directory for
+# files being created, written or renamed into it, or None if that isn't
+# possible (e.g. not linux, or the directory isn't local).
+# Note that on network filesystems (nfs-mounted dCache) inotify only sees
+# changes made from this node, so inotify can only shorten waits, not
+# replace polling.
+
+def inotify_dir(dir):
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    if libc.inotify_add_watch(fd, convert_bytes(dir),
+                              IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
 
-def wait_for_stat(path):
 
-    ntry = 60
-    while ntry > 0:
-        if larbatch_posix.access(path, os.R_OK):
-            return 0
-        print('Waiting ...')
+# Wait for file to appear on local filesystem.
+# Poll once per second for up to 60 seconds, but wake up early to recheck
+# if inotify reports a change in the parent directory.
 
-        # Reading the parent directory seems to make files be visible faster.
+def wait_for_stat(path):
 
-        larbatch_posix.listdir(os.path.dirname(path))
-        time.sleep(1)
-        ntry = ntry - 1
+    fd = inotify_dir(os.path.dirname(path))
+    try:
+        tend = time.time() + 60
+        tpoll = 0.
+        while True:
+            if larbatch_posix.access(path, os.R_OK):
+                return 0
+            now = time.time()
+            if now >= tend:
+                break
+
+            # Once per second, print a message and read the parent directory
+            # (reading the parent directory seems to make files be visible faster).
+            # Early inotify wakeups only recheck access.
+
+            if now >= tpoll:
+                print('Waiting ...')
+                larbatch_posix.listdir(os.path.dirname(path))
+                tpoll = now + 1
+            timeout = max(0., min(tpoll, tend) - time.time())
+            if fd == None:
+                time.sleep(timeout)
+            else:
+                r, w, x = select.select([fd], [], [], timeout)
+                if r:
+                    try:
+                        os.read(fd, 65536)
+                    except OSError:
+                        pass
+    finally:
+        if fd != None:
+            os.close(fd)
 
     # Timed out.
 
@@ -159,6 +199,7 @@ def wait_for_stat(path):
 
 def get_scratch_dir():
     scratch = ''
+    ok = False     # Set to True once scratch is known to be a writeable directory.
 
     # Get scratch directory path.
 
@@ -169,20 +210,34 @@ def get_scratch_dir():
         scratch = os.environ['SCRATCH']
 
     else:
-        scratch = '/scratch/%s/%s' % (get_experiment(), get_user())
-        if not larbatch_posix.isdir(scratch) or not larbatch_posix.access(scratch, os.W_OK):
-            scratch = '/%s/data/users/%s' % (get_experiment(), get_user())
+        experiment = get_experiment()
+        user = get_user()
+        scratch = '/scratch/%s/%s' % (experiment, user)
+        ok = writeable_dir(scratch)
+        if not ok:
+            scratch = '/%s/data/users/%s' % (experiment, user)
 
     # Checkout.
 
     if scratch == '':
         raise RuntimeError('No scratch directory specified.')
 
-    if not larbatch_posix.isdir(scratch) or not larbatch_posix.access(scratch, os.W_OK):
+    if not ok and not writeable_dir(scratch):
         raise RuntimeError('Scratch directory %s does not exist or is not writeable.' % scratch)
 
     return scratch
 
+
+# Test whether a path is an existing, writeable directory, using a single
+# stat for the directory test.
+
+def writeable_dir(path):
+    try:
+        sr = larbatch_posix.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(sr.st_mode) and larbatch_posix.access(path, os.W_OK)
+
 # Function to return the mountpoint of a given path.
 
 def mountpoint(path):
@@ -203,49 +258,57 @@ def mountpoint(path):
 
 
 # Function to escape dollar signs in string by prepending backslash (\).
+# Dollar signs that are already preceded by a backslash are left alone.
 
-def dollar_escape(s):
+unescaped_dollar = re.compile(r'(?<!\\)\$')
 
-    result = ''
-    for c in s:
-        if c == '$' and ( len(result) == 0 or result[-1] != '\\'):
-            result += '\\'
-        result += c
-    return result
+def dollar_escape(s):
+    return unescaped_dollar.sub(r'\\$', s)
 
 
 # Function to parse a string containing a comma- and hyphen-separated 
 # representation of a collection of positive integers into a sorted list 
 # of ints.  Raise ValueError excpetion in case of unparseable string.
 
-def parseInt(s):
+int_range_token = re.compile(r'\s*(\d+)\s*(?:-\s*(\d+)\s*)?$')
 
-    result = set()
+def parseInt(s):
 
     # First split string into tokens separated by commas.
+    # Each token is converted into an inclusive interval (first, last).
 
+    intervals = []
     for token in s.split(','):
+        m = int_range_token.match(token)
+        if m == None:
 
-        # Plain integers handled here.
+            # Don't understand.
 
-        if token.strip().isdigit():
-            result.add(int(token))
-            continue
+            raise ValueError('Unparseable range token %s.' % token)
 
-        # Hyphenenated ranges handled here.
+        first = int(m.group(1))
+        if m.group(2) == None:
 
-        limits = token.split('-')
-        if len(limits) == 2 and limits[0].strip().isdigit() and limits[1].strip().isdigit():
-            result |= set(range(int(limits[0]), int(limits[1])+1))
-            continue
+            # Plain integers handled here.
+
+            intervals.append((first, first))
+        else:
 
-        # Don't understand.
+            # Hyphenenated ranges handled here.
 
-        raise ValueError('Unparseable range token %s.' % token)
+            last = int(m.group(2))
+            if first <= last:
+                intervals.append((first, last))
 
-    # Return result in form of a sorted list.
+    # Sort and merge overlapping intervals, then expand into a sorted list.
 
-    return sorted(result)
+    intervals.sort()
+    result = []
+    for first, last in intervals:
+        if len(result) > 0 and first <= result[-1]:
+            first = result[-1] + 1
+        result.extend(range(first, last+1))
+    return result
 
 
 # Function to construct a new dataset definition from an existing definition
@@ -266,11 +329,7 @@ def create_limited_dataset(defname, run, subruns):
     # Construct comma-separated list of run-subrun pairs in a form that is
     # acceptable as sam dimension constraint.
 
-    run_subrun_dim = ''
-    for subrun in subruns:
-        if run_subrun_dim != '':
-            run_subrun_dim += ','
-        run_subrun_dim += "%d.%d" % (run, subrun)
+    run_subrun_dim = ','.join(["%d.%d" % (run, subrun) for subrun in subruns])
 
     # Construct dimension including run and subrun constraints.
 
@@ -288,6 +347,7 @@ def create_limited_dataset(defname, run, subruns):
 
     # Construct a new unique definition name.
 
+    import uuid
     newdefname = defname + '_' + str(uuid.uuid4())
 
     # Create definition.
@@ -309,6 +369,10 @@ def samweb():
 
     if samweb_obj == None:
 
+        # Samweb module is only imported when it is needed.
+
+        import samweb_cli
+
         # Do we want token or proxy authentication?
 
         if token_auth:
@@ -363,6 +427,8 @@ def start_project(defname, default_prjname, max_files, force_snapshot, filelistd
     # Make sure we have a certificate.
 
     test_kca()
+    user = get_user()
+    experiment = get_experiment()
 
     # Figure out how many files are in the input dataset.
 
@@ -391,7 +457,8 @@ def start_project(defname, default_prjname, max_files, force_snapshot, filelistd
                 limitdef = makeFileListDefinition(dim)
             else:
                 print('Creating limited dataset definition %s.' % limitdef)
-                s.createDefinition(limitdef, dim, user=get_user(), group=get_experiment())
+                s.createDefinition(limitdef, dim, user=user, group=experiment)
+                defcache[limitdef] = time.time()
 
         defname = limitdef
         nf = max_files
@@ -412,14 +479,26 @@ def start_project(defname, default_prjname, max_files, force_snapshot, filelistd
     print('Starting project %s.' % prjname)
     s.startProject(prjname,
                    defname=defname, 
-                   station=get_experiment(),
-                   group=get_experiment(),
-                   user=get_user())
+                   station=experiment,
+                   group=experiment,
+                   user=user)
 
     # Done.
 
     return 0
 
+# Return the project name stem (project name without timestamp, including
+# trailing underscore) for projects made from the specified dataset definition.
+# Return the empty string if the definition is the empty string.
+# Results are cached in global prjstem_cache.
+
+def project_stem(defname):
+    if defname == '':
+        return ''
+    if defname not in prjstem_cache:
+        prjstem_cache[defname] = '%s_' % samweb().makeProjectName(defname).rsplit('_',1)[0]
+    return prjstem_cache[defname]
+
 # Return a list of active projects associated with a particular dataset definition stem
 # based on project start and end times.  The particular criteria used in this function
 # are:
@@ -435,9 +514,7 @@ def active_projects2(defname = '', dropboxwait = 0.):
     # Get project name stem.
 
     s = samweb()
-    prjstem = ''
-    if defname != '':
-        prjstem = '%s_' % s.makeProjectName(defname).rsplit('_',1)[0]
+    prjstem = project_stem(defname)
 
     # Query a list of projects started within the last 72 hours.
 
@@ -446,27 +523,17 @@ def active_projects2(defname = '', dropboxwait = 0.):
     tminstr = tmin.strftime('%Y-%m-%dT%H:%M:%S')
     prjnames = s.listProjects(started_after = tminstr)
 
-    # Loop over projects to check end times.
-
-    for prjname in prjnames:
-        if prjstem == '' or prjname.startswith(prjstem):
-
-            # This project is a candidate for inclusion in result.
-            # Check end time.
+    # Check end times of candidate projects.
+    # Sam queries are done concurrently using a pool of threads.
 
-            age = 0
-            prjurl = s.findProject(project=prjname, station=get_experiment())
-            if prjurl != '':
-                prjsum = s.projectSummary(prjurl)
-                if 'project_end_time' in prjsum:
-                    tendstr = prjsum['project_end_time']
-                    if len(tendstr) >= 19:
-                        try:
-                            tend = datetime.datetime.strptime(tendstr[:19], '%Y-%m-%dT%H:%M:%S')
-                            tage = datetime.datetime.utcnow() - tend
-                            age = tage.total_seconds()
-                        except:
-                            pass
+    if prjstem == '':
+        candidates = list(prjnames)
+    else:
+        candidates = [prjname for prjname in prjnames if prjname.startswith(prjstem)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        ages = executor.map(project_age, [s] * len(candidates),
+                            [get_experiment()] * len(candidates), candidates)
+        for prjname, age in zip(candidates, ages):
 
             # Keep this project if there is no end time.
 
@@ -478,6 +545,28 @@ def active_projects2(defname = '', dropboxwait = 0.):
     return result
 
 
+# Return the time in seconds since the specified project ended (0 if the
+# project hasn't ended, or if the end time can't be determined).
+# The first two arguments are a SAMWebClient object and the station name.
+
+def project_age(s, station, prjname):
+
+    age = 0
+    prjurl = s.findProject(project=prjname, station=station)
+    if prjurl != '':
+        prjsum = s.projectSummary(prjurl)
+        if 'project_end_time' in prjsum:
+            tendstr = prjsum['project_end_time']
+            if len(tendstr) >= 19:
+                try:
+                    tend = datetime.datetime.strptime(tendstr[:19], '%Y-%m-%dT%H:%M:%S')
+                    tage = datetime.datetime.utcnow() - tend
+                    age = tage.total_seconds()
+                except:
+                    pass
+    return age
+
+
 # Return a list of active projects associated with a particular dataset definition stem.
 # If the definition argument is the empty string, return all active projects.
 
@@ -488,23 +577,30 @@ def active_projects(defname = ''):
     # Get project name stem.
 
     s = samweb()
-    prjstem = ''
-    if defname != '':
-        prjstem = '%s_' % s.makeProjectName(defname).rsplit('_',1)[0]
+    prjstem = project_stem(defname)
 
     # Dump station
 
     url = '%s/dumpStation?station=%s' % (s.get_baseurl(), get_experiment())
+    try:
+        import urllib.request as urlrequest
+    except ImportError:
+        import urllib as urlrequest
     furl = urlrequest.urlopen(url)
 
     # Parse response.
+    # Read one line at a time, and don't split more of each line than is needed
+    # to tell whether there are at least six words (project lines).
+    # Project names are compared as bytes, and only decoded if they match.
 
-    for line in furl.readlines():
-        words = line.split()
-        if len(words) > 5:
-            prjname = convert_str(words[0])
-            if prjstem == '' or prjname.startswith(prjstem):
-                result.add(prjname)
+    prjstem_bytes = convert_bytes(prjstem)
+    try:
+        for line in furl:
+            words = line.split(None, 6)
+            if len(words) > 5 and words[0].startswith(prjstem_bytes):
+                result.add(convert_str(words[0]))
+    finally:
+        furl.close()
 
     # Done.
 
@@ -521,24 +617,27 @@ def make_active_project_dataset(defname, dropboxwait, active_defname, wait_defna
 
     s = samweb()
     test_kca()
+    user = get_user()
+    group = get_experiment()
 
     # Get list of active projects.
+    # The two queries are independent, so do them concurrently.
+    # Both need the project name stem, so look it up first (and cache it),
+    # rather than letting both threads ask sam for it.
 
-    prjs = active_projects(defname) | active_projects2(defname, dropboxwait)
+    project_stem(defname)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        prjs1 = executor.submit(active_projects, defname)
+        prjs2 = executor.submit(active_projects2, defname, dropboxwait)
+        prjs = prjs1.result() | prjs2.result()
 
     # Make sam dimension.
-
-    dim = ''
-    for prj in prjs:
-        if dim == '':
-            dim = 'snapshot_for_project_name %s' % prj
-        else:
-            dim += ',%s' % prj
-
     # If there were no matching projects, make up some legal dimension that won't
     # match any files.
 
-    if dim == '':
+    if len(prjs) > 0:
+        dim = 'snapshot_for_project_name %s' % ','.join(prjs)
+    else:
         dim = 'file_id 0'
 
     # Create or update active_defname.
@@ -546,10 +645,12 @@ def make_active_project_dataset(defname, dropboxwait, active_defname, wait_defna
     if defExists(active_defname):
         print('Updating dataset definition %s' % active_defname)
         s.deleteDefinition(active_defname)
+        defcache.pop(active_defname, None)
     else:
         print('Creating dataset definition %s' % active_defname)
 
-    s.createDefinition(active_defname, dim, user=get_user(), group=get_experiment())
+    s.createDefinition(active_defname, dim, user=user, group=group)
+    defcache[active_defname] = time.time()
 
     # If the dropbox waiting interval is nonzero, create a dataset for 
     # dropbox waiting files.
@@ -584,21 +685,35 @@ def make_active_project_dataset(defname, dropboxwait, active_defname, wait_defna
     if defExists(wait_defname):
         print('Updating dataset definition %s' % wait_defname)
         s.deleteDefinition(wait_defname)
+        defcache.pop(wait_defname, None)
     else:
         print('Creating dataset definition %s' % wait_defname)
 
-    s.createDefinition(wait_defname, dim, user=get_user(), group=get_experiment())
+    s.createDefinition(wait_defname, dim, user=user, group=group)
+    defcache[wait_defname] = time.time()
 
 
 # Function to check whether a sam dataset definition exists.
 
 def defExists(defname):
+
+    # Check cache.
+    # Only definitions that were recently found to exist are cached.
+
+    t = defcache.get(defname)
+    if t != None and time.time() - t < defcache_ttl:
+        return True
+
     def_exists = False
     try:
         samweb().descDefinition(defname)
         def_exists = True
     except:
         def_exists = False
+    if def_exists:
+        defcache[defname] = time.time()
+    else:
+        defcache.pop(defname, None)
     return def_exists
 
 
@@ -613,6 +728,7 @@ def makeDummyDef(defname):
         print('Making dummy dataset definition %s' % defname)
         test_kca()
         samweb().createDefinition(defname, 'file_id 0', user=get_user(), group=get_experiment())
+        defcache[defname] = time.time()
 
 
 # Function to ensure that files in dCache have layer two.
@@ -637,42 +753,28 @@ def addLayerTwo(path, recreate=True):
         larbatch_posix.remove(path)
         if not recreate:
             return
-        test_proxy()
-
-        # Make sure environment variables X509_USER_CERT and X509_USER_KEY
-        # are not defined (they confuse ifdh).
-
-        save_vars = {}
-        for var in ('X509_USER_CERT', 'X509_USER_KEY'):
-            if var in os.environ:
-                save_vars[var] = os.environ[var]
-                del os.environ[var]
-
-        # Do ifdh cp.
-
-        command = ['ifdh', 'cp', '/dev/null', path]
-        jobinfo = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        q = queue.Queue()
-        thread = threading.Thread(target=wait_for_subprocess, args=[jobinfo, q])
-        thread.start()
-        thread.join(timeout=60)
-        if thread.is_alive():
-            print('Terminating subprocess.')
-            jobinfo.terminate()
-            thread.join()
-        rc = q.get()
-        jobout = convert_str(q.get())
-        joberr = convert_str(q.get())
-        if rc != 0:
-            for var in list(save_vars.keys()):
-                os.environ[var] = save_vars[var]
-            raise IFDHError(command, rc, jobout, joberr)
-
-        # Restore environment variables.
-
-        for var in list(save_vars.keys()):
-            os.environ[var] = save_vars[var]
+
+        # Do ifdh cp (raise IFDHError if it fails).
+        # The ifdh environment (without X509_USER_CERT and X509_USER_KEY, which
+        # confuse ifdh) and the timeout are handled by run_ifdh.
+
+        larbatch_utilities.run_ifdh(['cp', '/dev/null', path], 60)
+
+# Like addLayerTwo, for a list of files.
+# Only files in dCache (/pnfs/...) may need ifdh.  If there is more than one
+# of them, they are processed concurrently, using the ifdh thread pool (which
+# gets a proxy up front).  Other files are checked serially, without needing
+# a proxy.
+
+def addLayerTwoMany(paths, recreate=True):
+    pnfs_paths = [path for path in paths if path[0:6] == '/pnfs/']
+    for path in paths:
+        if path[0:6] != '/pnfs/':
+            addLayerTwo(path, recreate)
+    if len(pnfs_paths) == 1:
+        addLayerTwo(pnfs_paths[0], recreate)
+    elif len(pnfs_paths) > 1:
+        larbatch_utilities.ifdh_map(addLayerTwo, pnfs_paths, recreate)
 
 # This function returns jobsub_submit options that should be included for 
 # all batch submissions.
@@ -695,6 +797,9 @@ def batch_status_check():
 # The actual implementations have been moved to larbatch_posix or 
 # larbatch_utilities, with a different name.
 
+def wait_for_subprocess(jobinfo, q, input=None):
+    larbatch_utilities.wait_for_subprocess(jobinfo, q, input)
+
 def safeexist(path):
     return larbatch_posix.exists(path)
 
@@ -717,18 +822,46 @@ def path_to_local(path):
     return path
 
 # Expand "defname:" clauses in a sam dimension.
+# Optional argument descs is a dictionary of definition descriptions
+# (descs[defname] = descDefinitionDict(defname)), which is used as a cache
+# and updated by this function.
 
-def expandDefnames(dim):
+def expandDefnames(dim, descs=None):
 
-    result = ''
-    isdefname = False
+    if descs == None:
+        descs = {}
     words = dim.split()
 
+    # Find definitions that haven't already been described.
+
+    defnames = []
+    isdefname = False
     for word in words:
         if isdefname:
             isdefname = False
-            desc = samweb().descDefinitionDict(word)
-            descdim = desc['dimensions']
+            if word not in descs and word not in defnames:
+                defnames.append(word)
+        elif word == 'defname:':
+            isdefname = True
+
+    # Fetch descriptions (concurrently if there is more than one).
+
+    if len(defnames) == 1:
+        descs[defnames[0]] = samweb().descDefinitionDict(defnames[0])
+    elif len(defnames) > 1:
+        s = samweb()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            for defname, desc in zip(defnames, executor.map(s.descDefinitionDict, defnames)):
+                descs[defname] = desc
+
+    # Make expanded dimension.
+
+    result = ''
+    isdefname = False
+    for word in words:
+        if isdefname:
+            isdefname = False
+            descdim = descs[word]['dimensions']
 
             # If this definition doesn't contain a top level or" or "minus" clause, 
             # leave it unexpanded.
@@ -736,7 +869,7 @@ def expandDefnames(dim):
             if descdim.find(' or ') < 0 and descdim.find(' minus ') < 0:
                 result += ' defname: %s' % word
             else:
-                result += ' ( %s )' % desc['dimensions']
+                result += ' ( %s )' % descdim
              
         else:
             if word == 'defname:':
@@ -766,7 +899,7 @@ def tokenizeRPN(dim):
 
     temp = []
     result = []
-    exp = ''
+    exp = []        # Words of current sam dimension expression.
 
     # Split of final "with limit" clause, if any.
 
@@ -791,15 +924,15 @@ def tokenizeRPN(dim):
 
         if word == '(' or word  == 'isparentof:(' or word == 'ischildof:(':
             if len(exp) > 0:
-                result.append(exp)
-                exp = ''
+                result.append(' '.join(exp))
+                exp = []
             temp.append(word)
 
         elif word == 'or' or word == 'minus':
 
             if len(exp) > 0:
-                result.append(exp)
-                exp = ''
+                result.append(' '.join(exp))
+                exp = []
 
             done = False
             while len(temp) > 0 and not done:
@@ -814,8 +947,8 @@ def tokenizeRPN(dim):
         elif word == ')':
 
             if len(exp) > 0:
-                result.append(exp)
-                exp = ''
+                result.append(' '.join(exp))
+                exp = []
 
             done = False
             while not done:
@@ -838,15 +971,12 @@ def tokenizeRPN(dim):
                     result.append(last)
 
         else:
-            if len(exp) == 0:
-                exp = word
-            else:
-                exp += ' %s' % word
+            exp.append(word)
 
     # Clear remaining items.
 
     if len(exp) > 0:
-        result.append(exp)
+        result.append(' '.join(exp))
     while len(temp) > 0:
         result.append(temp.pop())
 
@@ -876,16 +1006,18 @@ def listFiles(dim):
 
     # Check cache.
 
+    load_samcache()
     if dim in samcache:
         print('Fetching result from sam cache.')
-        return samcache[dim]
+        return set(samcache[dim])
 
     # As a first step, expand out "defname:" clauses containing top level "or" or "minus"
     # clauses.
 
+    descs = {}
     done = False
     while not done:
-        newdim = expandDefnames(dim)
+        newdim = expandDefnames(dim, descs)
         if newdim == dim:
             done = True
         else:
@@ -925,8 +1057,8 @@ def listFiles(dim):
             # Truncate set on top of stack.
 
             n = int(item[10:])
-            while len(stack[-1]) > n:
-                stack[-1].pop()
+            if len(stack[-1]) > n:
+                stack[-1] = frozenset(itertools.islice(stack[-1], n))
             print('Truncated to %d files' % len(stack[-1]))
 
         else:
@@ -940,16 +1072,98 @@ def listFiles(dim):
                 print('Fetching result from cache.')
                 files = samcache[item]
             else:
-                files = set(samweb().listFiles(item))
+                files = frozenset(sys.intern(f) for f in samweb().listFiles(item, stream=True))
                 samcache[item] = files
+                samcache_time[item] = time.time()
             print('Result %d files' % len(files))
             stack.append(files)
 
     # Done.
 
     print('Final result %d files' % len(stack[-1]))
-    samcache[dim] = stack[-1]
-    return stack[-1]
+    samcache[dim] = frozenset(stack[-1])
+    samcache_time[dim] = time.time()
+
+    # Return a mutable copy, so that callers can't modify the cached set.
+
+    return set(stack[-1])
+
+# Persistent sam cache.
+#
+# If environment variable SAMCACHE_TTL is set to a positive number of seconds,
+# the sam query cache (samcache) is saved in the scratch directory when this
+# process exits, and loaded by the next process that calls listFiles.
+# Saved entries older than SAMCACHE_TTL seconds are discarded.
+# The persistent cache is disabled by default, because query results may
+# change between invocations.
+
+def samcache_ttl():
+    try:
+        return float(os.environ.get('SAMCACHE_TTL', 0))
+    except ValueError:
+        return 0.
+
+
+# Path of persistent sam cache file.
+
+def samcache_path():
+    return os.path.join(get_scratch_dir(), 'samcache_%d.pkl' % os.getuid())
+
+
+# Load persistent sam cache (once per process).
+
+def load_samcache():
+
+    global samcache_loaded
+    if samcache_loaded:
+        return
+    samcache_loaded = True
+    ttl = samcache_ttl()
+    if ttl <= 0.:
+        return
+
+    # Save cache when this process exits.
+
+    atexit.register(save_samcache)
+
+    # Read cache file (ignore any errors).
+
+    try:
+        with open(samcache_path(), 'rb') as f:
+            data = pickle.load(f)
+    except Exception:
+        return
+
+    now = time.time()
+    for dim in data:
+        t, files = data[dim]
+        if now - t < ttl and dim not in samcache:
+            samcache[dim] = frozenset(files)
+            samcache_time[dim] = t
+
+
+# Save persistent sam cache.
+# The cache file is replaced atomically, so that concurrent processes always
+# see a complete file.
+
+def save_samcache():
+
+    ttl = samcache_ttl()
+    now = time.time()
+    data = {}
+    for dim in samcache:
+        t = samcache_time.get(dim, now)
+        if now - t < ttl:
+            data[dim] = (t, samcache[dim])
+    try:
+        path = samcache_path()
+        tmppath = '%s.%d' % (path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+    except Exception:
+        pass
+
 
 # Make a sam dataset definition consisting of a list of files.  The file
 # list can be passed directly as an argument, or be evaluated by function
@@ -973,22 +1187,20 @@ def makeFileListDefinition(list_or_dim):
         flist = listFiles(list_or_dim)
         print('Making file list definition using dimension "%s"' % list_or_dim)
 
-    listdim=''
-    for filename in flist:
-        if listdim == '':
-            listdim = 'file_name %s' % filename
-        else:
-            listdim += ', %s' % filename
-    if listdim == '':
+    if len(flist) > 0:
+        listdim = 'file_name %s' % ', '.join(flist)
+    else:
         listdim = 'file_id 0'
 
     # Maybe construct a new unique definition name.
 
-    defname = get_user() + '_filelist_' + str(uuid.uuid4())
+    user = get_user()
+    import uuid
+    defname = user + '_filelist_' + str(uuid.uuid4())
 
     # Create definition.
 
-    samweb().createDefinition(defname, listdim, user=get_user(), group=get_experiment())
+    samweb().createDefinition(defname, listdim, user=user, group=get_experiment())
 
     # Done.
 
@@ -1002,6 +1214,12 @@ def makeFileListDefinition(list_or_dim):
 
 def get_singularity(name):
 
+    # Check cache (relative paths depend on the current directory).
+
+    key = (os.getcwd(), name)
+    if key in singularity_cache:
+        return singularity_cache[key]
+
     result = ''
     dir = '/cvmfs/singularity.opensciencegrid.org/fermilab'
     lcname = name.lower()
@@ -1022,4 +1240,5 @@ def get_singularity(name):
 
     # Done.
 
+    singularity_cache[key] = result
     return result
@@ -6,14 +6,27 @@ from __future__ import print_function
 # Import stuff.
 
 import sys, os, subprocess, json, stream
+import mmap
+import concurrent.futures
 import larbatch_posix
 import larbatch_utilities
 from larbatch_utilities import convert_str
 import project_utilities
 
-# Defer importing ROOT.
+# Use an accelerated (vectorized) zlib implementation for checksums, if available.
+
+try:
+    from zlib_ng import zlib_ng as zlib
+except ImportError:
+    try:
+        from isal import isal_zlib as zlib
+    except ImportError:
+        import zlib
+
+# Defer importing ROOT and uproot.
 
 ROOT = None
+uproot = None     # Set to False if uproot is not available.
 
 # Filter warnings.
 
@@ -24,48 +37,198 @@ warnings.filterwarnings('ignore', category = RuntimeWarning, message = 'creating
 
 def convert_1_adler32_to_0_adler32(crc, filesize):
     crc = int(crc)
-    filesize = int(filesize)
-    size = int(filesize % 65521)
-    s1 = (crc & 0xffff)
-    s2 = ((crc >> 16) &  0xffff)
-    s1 = (s1 + 65521 - 1) % 65521
-    s2 = (s2 + 65521 - size) % 65521
+    size = int(filesize) % 65521
+    s1 = ((crc & 0xffff) + 65520) % 65521
+    s2 = (((crc >> 16) & 0xffff) + 65521 - size) % 65521
     return (s2 << 16) + s1
 
 
 # Checksum utilities copied from sam_web_client
 
+class Error(Exception):
+    """Checksum error (as raised by sam_web_client checksum utilities)."""
+    pass
+
+def posixChecksumOk(path):
+    """Return True if a file can be checksummed by reading it directly
+    (mmap or pread).  Same rule as larbatch_posix.open, which routes dCache
+    paths to dcache_file if pnfs isn't mounted or grid access is preferred."""
+
+    if path.startswith('/pnfs/'):
+        return larbatch_posix.pnfs_is_mounted and not larbatch_posix.prefer_grid
+    return True
+
 def enstoreChecksum(fileobj):
-    import zlib
-    readblocksize = 1024*1024
+    readblocksize = 4*1024*1024
     crc = 0
-    while 1:
-        try:
-            s = fileobj.read(readblocksize)
-        except (OSError, IOError) as ex:
-            raise Error(str(ex))
-        if not s: break
-        crc = zlib.adler32(s,crc)
+    # Read the next block in a separate thread while checksumming the
+    # current block (both release the GIL).
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        future = reader.submit(fileobj.read, readblocksize)
+        while 1:
+            try:
+                s = future.result()
+            except (OSError, IOError) as ex:
+                raise Error(str(ex))
+            if not s: break
+            future = reader.submit(fileobj.read, readblocksize)
+            crc = zlib.adler32(s,crc)
+    return enstoreChecksumDict(crc)
+
+def enstoreChecksumDict(crc):
+    """Format adler32 value as enstore checksum dictionary"""
     crc = int(crc)
     if crc < 0:
         # Return 32 bit unsigned value
         crc  = (crc & 0x7FFFFFFF) | 0x80000000
     return { "crc_value" : str(crc), "crc_type" : "adler 32 crc type" }
 
+def mmapEnstoreChecksum(path):
+    """Calculate enstore compatible CRC value of a file using mmap.
+    Return None if the file can't be memory-mapped."""
+
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        try:
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files can't be mapped.
+            return None
+        try:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            # Checksum in large zero-copy slices.
+            mapblocksize = 64*1024*1024
+            crc = 0
+            view = memoryview(mm)
+            try:
+                for offset in range(0, len(view), mapblocksize):
+                    crc = zlib.adler32(view[offset:offset+mapblocksize], crc)
+            finally:
+                view.release()
+        finally:
+            mm.close()
+    finally:
+        os.close(fd)
+    return enstoreChecksumDict(crc)
+
+def adler32Combine(crc1, crc2, len2):
+    """Combine adler32 checksum crc1 of a first block with checksum crc2 of a
+    second block of length len2 (crc2 calculated with the default starting
+    value), giving the checksum of the concatenated blocks.  Same algorithm
+    as zlib's adler32_combine, which python's zlib doesn't provide."""
+
+    base = 65521
+    rem = len2 % base
+    sum1 = crc1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 = (sum1 + (crc2 & 0xffff) + base - 1) % base
+    sum2 = (sum2 + ((crc1 >> 16) & 0xffff) + ((crc2 >> 16) & 0xffff) + base - rem) % base
+    return (sum2 << 16) | sum1
+
+def preadEnstoreChecksum(path, nthreads=4):
+    """Calculate enstore compatible CRC value of a file by checksumming
+    disjoint blocks in parallel threads using os.pread, and combining the
+    results.  Return None if the file can't be opened, or if it changes
+    size while being read (the caller then falls back to a sequential read)."""
+
+    if not hasattr(os, 'pread'):
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        readblocksize = 16*1024*1024
+
+        # Checksum one block.  Pread may return fewer bytes than requested
+        # (e.g. on fuse or nfs mounts), so keep reading until the whole block
+        # has been read.  Return None if end of file is reached early.
+
+        def block_adler32(offset):
+            block_len = min(readblocksize, size - offset)
+            block_crc = 1
+            n = 0
+            while n < block_len:
+                s = os.pread(fd, block_len - n, offset + n)
+                if not s:
+                    return None
+                block_crc = zlib.adler32(s, block_crc)
+                n += len(s)
+            return block_crc, block_len
+
+        # Map returns results in order, and at most nthreads blocks are in memory.
+
+        crc = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) as executor:
+            for block in executor.map(block_adler32, range(0, size, readblocksize)):
+                if block == None:
+                    return None
+                crc = adler32Combine(crc, block[0], block[1])
+
+        # Make sure the file didn't grow while it was being read.
+
+        if os.fstat(fd).st_size != size:
+            return None
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    return enstoreChecksumDict(crc)
+
 def fileEnstoreChecksum(path):
     """Calculate enstore compatible CRC value"""
 
-    crc = {}
+    # Local files can be memory-mapped.  Files in mounted dCache are read
+    # using pread (an mmap of an nfs file that changes can crash with SIGBUS).
+    # Otherwise, read the file as a stream via larbatch_posix.
+
+    crc = None
+    if not path.startswith('/pnfs/'):
+        crc = mmapEnstoreChecksum(path)
+    if crc == None and posixChecksumOk(path):
+        crc = preadEnstoreChecksum(path)
+    if crc != None:
+        return crc
+
     try:
         f = larbatch_posix.open(path,'rb')
-        crc = enstoreChecksum(f)
     except (IOError, OSError) as ex:
         raise Error(str(ex))
+    try:
+        crc = enstoreChecksum(f)
     finally:
         f.close()
     return crc
 
-def get_external_metadata(inputfile):
+def dcacheChecksum(path):
+    """Return the adler32 checksum (adler32-1, as an int) that dCache has
+    stored for a file, or None if not available.  The checksum is read via
+    the dCache nfs dot-command file ".(get)(<name>)(checksums)", which
+    contains a list of checksums like "ADLER32:0123abcd"."""
+
+    if not path.startswith('/pnfs/'):
+        return None
+    dir, name = os.path.split(path)
+    try:
+        with open(os.path.join(dir, '.(get)(%s)(checksums)' % name)) as f:
+            checksums = f.read()
+    except (IOError, OSError):
+        return None
+    for checksum in checksums.replace(',', '\n').split():
+        words = checksum.split(':', 1)
+        if len(words) == 2 and words[0].upper() == 'ADLER32':
+            try:
+                return int(words[1], 16)
+            except ValueError:
+                pass
+    return None
+
+def import_root():
 
     global ROOT
 
@@ -86,46 +249,120 @@ def get_external_metadata(inputfile):
         ROOT.gErrorIgnoreLevel = ROOT.kError
         sys.argv = myargv
 
-    # define an empty python dictionary
-    md = {}
+def uproot_metadata(inputfile, md):
+    """Fill number of events and subruns using uproot, which only reads the
+    needed tree headers and branches, without initializing ROOT.
+    Return True if successful, or False if ROOT should be used instead
+    (uproot not available or unable to read the file)."""
 
-    # Check whether this file exists.
-    if not os.path.exists(inputfile):
-        return md
-            
-    # Get the other meta data field parameters                                          
-    md['file_name'] =  os.path.basename(inputfile)
-    md['file_size'] =  str(os.path.getsize(inputfile))
-    md['crc'] = fileEnstoreChecksum(inputfile)
+    global uproot
 
-    # Quit here if file type is not ".root"
+    # Import uproot, if not already done.
 
-    if not inputfile.endswith('.root'):
-        return md
+    if uproot == None:
+        try:
+            import uproot
+        except ImportError:
+            uproot = False
+    if uproot == False:
+        return False
+    import numpy     # Required by uproot.
+
+    result = {}
+    try:
+        with uproot.open(larbatch_posix.root_stream(inputfile)) as file:
+            classnames = file.classnames(recursive=False, cycle=False)
 
-    # Root checks.
+            # Get number of events.
 
-    ROOT.gEnv.SetValue('RooFit.Banner', '0')
-    file = ROOT.TFile.Open(larbatch_posix.root_stream(inputfile))
-    if file and file.IsOpen() and not file.IsZombie():
+            if classnames.get('Events') == 'TTree':
+                result['events'] = str(file['Events'].num_entries)
 
-        # Root file opened successfully.
-        # Get number of events.
+            # Get runs and subruns from SubRuns tree.
+
+            if classnames.get('SubRuns') == 'TTree':
+                run_leaf = 'SubRunAuxiliary.id_.run_.run_'
+                subrun_leaf = 'SubRunAuxiliary.id_.subRun_'
+                arrays = file['SubRuns'].arrays(filter_name=[run_leaf, subrun_leaf],
+                                                library='np')
+                if run_leaf not in arrays or subrun_leaf not in arrays:
+                    return False
+
+                # Find unique (run, subrun) pairs, keeping first-seen order.
+
+                pairs = numpy.column_stack([arrays[run_leaf], arrays[subrun_leaf]])
+                pairs, first = numpy.unique(pairs, axis=0, return_index=True)
+                pairs = pairs[numpy.argsort(first)]
+                result['subruns'] = [tuple(pair) for pair in pairs.tolist()]
+    except Exception:
+        return False
+
+    md.update(result)
+    return True
+
+def tfile_metadata(file, md):
+    """Fill number of events and subruns from an open ROOT TFile."""
+
+    # Get number of events.
             
-        obj = file.Get('Events')
-        if obj and obj.InheritsFrom('TTree'):
+    obj = file.Get('Events')
+    if obj and obj.InheritsFrom('TTree'):
+
+        # This has a TTree named Events.
+
+        nev = obj.GetEntriesFast()
+        md['events'] = str(nev)
+
+    # Get runs and subruns fro SubRuns tree.
+
+    subrun_tree = file.Get('SubRuns')
+    if subrun_tree and subrun_tree.InheritsFrom('TTree'):
+        md['subruns'] = []
+        seen = set()
+        nsubruns = subrun_tree.GetEntriesFast()
+
+        # Only read the SubRunAuxiliary branches (not subrun data products).
 
-            # This has a TTree named Events.
+        subrun_tree.SetBranchStatus('*', 0)
+        subrun_tree.SetBranchStatus('SubRunAuxiliary*', 1)
 
-            nev = obj.GetEntriesFast()
-            md['events'] = str(nev)
+        # Prefetch the SubRunAuxiliary baskets through a TTreeCache, rather
+        # than issuing a small read per entry (matters for xrootd).
 
-        # Get runs and subruns fro SubRuns tree.
+        subrun_tree.SetCacheSize(10*1024*1024)
+        subrun_tree.AddBranchToCache('SubRunAuxiliary*', True)
+        subrun_tree.StopCacheLearningPhase()
 
-        subrun_tree = file.Get('SubRuns')
-        if subrun_tree and subrun_tree.InheritsFrom('TTree'):
+        # Add unique (run, subrun) pair, keeping first-seen order.
+
+        def add_subrun(run, subrun):
+            run_subrun = (run, subrun)
+            if not run_subrun in seen:
+                seen.add(run_subrun)
+                md['subruns'].append(run_subrun)
+
+        # Read run and subrun leaves using typed TTreeReaderValues.
+
+        reader = ROOT.TTreeReader(subrun_tree)
+        run_value = ROOT.TTreeReaderValue('unsigned int')(reader,
+                                                          'SubRunAuxiliary.id_.run_.run_')
+        subrun_value = ROOT.TTreeReaderValue('unsigned int')(reader,
+                                                             'SubRunAuxiliary.id_.subRun_')
+        reader_ok = True
+        while reader.Next():
+            if run_value.GetSetupStatus() < 0 or subrun_value.GetSetupStatus() < 0:
+                reader_ok = False
+                break
+            add_subrun(int(run_value.Get()[0]), int(subrun_value.Get()[0]))
+        if run_value.GetSetupStatus() < 0 or subrun_value.GetSetupStatus() < 0:
+            reader_ok = False
+
+        # Fall back to TTreeFormula, if the leaves can't be read directly
+        # (e.g. SubRunAuxiliary not split).
+
+        if not reader_ok:
             md['subruns'] = []
-            nsubruns = subrun_tree.GetEntriesFast()
+            seen.clear()
             tfr = ROOT.TTreeFormula('subruns',
                                     'SubRunAuxiliary.id_.run_.run_',
                                     subrun_tree)
@@ -134,12 +371,52 @@ def get_external_metadata(inputfile):
                                     subrun_tree)
             for entry in range(nsubruns):
                 subrun_tree.GetEntry(entry)
-                run = tfr.EvalInstance64()
-                subrun = tfs.EvalInstance64()
-                run_subrun = (run, subrun)
-                if not run_subrun in md['subruns']:
-                    md['subruns'].append(run_subrun)
+                add_subrun(tfr.EvalInstance64(), tfs.EvalInstance64())
+
+def get_external_metadata(inputfile):
+
+    # define an empty python dictionary
+    md = {}
+
+    # Check whether this file exists (single stat, reused for size).
+    try:
+        st = os.stat(inputfile)
+    except OSError:
+        return md
+            
+    # Get the other meta data field parameters                                          
+    md['file_name'] =  os.path.basename(inputfile)
+    md['file_size'] =  str(st.st_size)
+
+    # Use the checksum stored by dCache, if there is one, otherwise read the file.
 
+    crc = dcacheChecksum(inputfile)
+    if crc != None:
+        md['crc'] = enstoreChecksumDict(convert_1_adler32_to_0_adler32(crc, md['file_size']))
+    else:
+        md['crc'] = fileEnstoreChecksum(inputfile)
+
+    # Quit here if file type is not ".root"
+
+    if not inputfile.endswith('.root'):
+        return md
+
+    # Root checks.
+    # Try uproot first, with ROOT as fallback.
+
+    if uproot_metadata(inputfile, md):
+        ok = True
+    else:
+        import_root()
+        ROOT.gEnv.SetValue('RooFit.Banner', '0')
+        file = ROOT.TFile.Open(larbatch_posix.root_stream(inputfile))
+        ok = file and file.IsOpen() and not file.IsZombie()
+        if ok:
+            tfile_metadata(file, md)
+
+    if ok:
+
+        # Root file opened successfully.
         # Get stream name.
 
         try:
@@ -1451,12 +1451,13 @@ def docheck(project, stage, ana, quick=False):
 
     # Close files.
 
+    empty_lists = []
     filelist.close()
     if nfile == 0:
-        project_utilities.addLayerTwo(filelistname)
+        empty_lists.append(filelistname)
     eventslist.close()
     if nfile == 0:
-        project_utilities.addLayerTwo(eventslistname)
+        empty_lists.append(eventslistname)
     if nerror == 0:
         badfile.write('\n')
     badfile.close()
@@ -1465,7 +1466,8 @@ def docheck(project, stage, ana, quick=False):
     missingfiles.close()
     filesanalist.close()
     if len(filesana) == 0:
-        project_utilities.addLayerTwo(filesanalistname)
+        empty_lists.append(filesanalistname)
+    project_utilities.addLayerTwoMany(empty_lists)
     if len(uris) == 0:
         urislist.write('\n')
     urislist.close()
@@ -2268,6 +2270,7 @@ def doundefine(defname):
         print('Deleting definition: %s' % defname)
         project_utilities.test_kca()
         samweb.deleteDefinition(defname=defname)
+        project_utilities.defcache.pop(defname, None)
     else:
         print('No such definition: %s' % defname)
 
@@ -7,31 +7,37 @@
 #
 # Created: 27-Nov-2012  Herbert Greenlee
 #
-# Usage:
-#
-# stat.py <options> [@filelist] [file1 file2 ...]
-#
-# Options:
-#
-# [-h|--help] - Print help message.
-# --level n   - Branch level (default 1).  Use --level 1 to see top
-#               branches only.  Use --level 2 to also see subbranches.
-# --nfile n   - Number of files to analyze (default all).
-# --all       - Print analysis of each file (default is only summary).
-# --s1        - Sort branches by uncompressed size.
-# --s2        - Sort branches by compressed size (default).
-# --s3        - Sort branches by name.
-#
-# Arguments:
-#
-# @filelist       - File list containing one input file per line.
-# file1 file2 ... - Input files.
+# Usage: see module docstring (rootstat.py --help).
 #
 ######################################################################
 
+"""
+stat.py <options> [@filelist] [file1 file2 ...]
+
+Options:
+
+[-h|--help] - Print help message.
+--level n   - Branch level (default 1).  Use --level 1 to see top
+              branches only.  Use --level 2 to also see subbranches.
+--nfile n   - Number of files to analyze (default all).
+--all       - Print analysis of each file (default is only summary).
+--s1        - Sort branches by uncompressed size.
+--s2        - Sort branches by compressed size (default).
+--s3        - Sort branches by name.
+
+Arguments:
+
+@filelist       - File list containing one input file per line.
+file1 file2 ... - Input files.
+"""
+
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os
+import operator
+import collections
+import itertools
+import concurrent.futures
 import project_utilities
 import larbatch_posix
 
@@ -47,25 +53,53 @@ import ROOT
 ROOT.gErrorIgnoreLevel = ROOT.kError
 sys.argv = myargv
 
-# Print help.
+# Input files are opened ahead in worker threads, so that network latency of
+# opening files on dCache overlaps.  Release the GIL while TFile::Open waits.
+#
+# The __release_gil__ flag is supported by the cppyy-based PyROOT (ROOT 6.22
+# and later).  In versions where TFile.Open is replaced by a python
+# pythonization, the flag must be set on the wrapped C++ overload
+# (TFile._OriginalOpen), since setting it on a python function has no effect.
+# Legacy PyROOT (before ROOT 6.22) doesn't support the flag (AttributeError),
+# in which case opens hold the GIL, and only overlap with analysis to the
+# extent that root itself releases the GIL.
 
-def help():
+ROOT.EnableThreadSafety()
+try:
+    getattr(ROOT.TFile, '_OriginalOpen', ROOT.TFile.Open).__release_gil__ = True
+except AttributeError:
+    pass
 
-    filename = sys.argv[0]
-    file = open(filename)
+# Number of input files to open ahead.
 
-    doprint=0
-    
-    for line in file.readlines():
-        if line[2:9] == 'stat.py':
-            doprint = 1
-        elif line[0:6] == '######' and doprint:
-            doprint = 0
-        if doprint:
-            if len(line) > 2:
-                print(line[2:], end=' ')
-            else:
-                print()
+open_ahead = 8
+
+# Print help.
+
+def help():
+    print(__doc__.strip())
+
+# Return a sort key for branch tuples (ntot, nzip, comp, name).
+# Sort type 1 = uncompressed size, 2 = compressed size, 3 = name.
+
+def branch_sort_key(sorttype):
+    if sorttype == 1:
+        return operator.itemgetter(0)
+    elif sorttype == 2:
+        return operator.itemgetter(1)
+    return operator.itemgetter(3)
+
+# Open input file (called in worker thread).
+# Return tuple (exists, root).  Root is None or a null TFile if the open
+# failed (newer versions of PyROOT raise OSError).
+
+def open_input(input_file):
+    if not larbatch_posix.exists(input_file):
+        return (False, None)
+    try:
+        return (True, ROOT.TFile.Open(input_file))
+    except OSError:
+        return (True, None)
 
 # Analyze root file.
 
@@ -95,10 +129,7 @@ def analyze(root, level, gtrees, gbranches, doprint, sorttype):
 
         # Remember information about trees.
 
-        if key in gtrees:
-            gtrees[key] = gtrees[key] + nentry
-        else:
-            gtrees[key] = nentry
+        gtrees[key] = gtrees.get(key, 0) + nentry
 
     # Print summary of branches in Events tree.
 
@@ -112,7 +143,7 @@ def analyze(root, level, gtrees, gbranches, doprint, sorttype):
 
     if events:
 
-        branch_tuples = {}
+        branch_tuples = []
 
         if doprint:
             print('   Total bytes  Zipped bytes   Comp.  Branch name')
@@ -135,13 +166,31 @@ def analyze(root, level, gtrees, gbranches, doprint, sorttype):
                 
                 subbranches = branch.GetListOfBranches()
                 for subbranch in subbranches:
-                    name = subbranch.GetName()
+                    name = sys.intern(subbranch.GetName())
 
                     # Only look at '.obj' subbranch (wrapped object).
                     
                     if name[-4:] == '.obj':
-                        ntot = subbranch.GetTotBytes("*")
-                        nzip = subbranch.GetZipBytes("*")
+
+                        # If we need subsubbranch sizes, get them first, and add them
+                        # to the subbranch's own size, rather than letting root
+                        # walk the subsubbranches twice.
+
+                        subsub_sizes = []
+                        if level > 1:
+                            subsubbranches = subbranch.GetListOfBranches()
+                            for subsubbranch in subsubbranches:
+                                subsub_sizes.append((sys.intern(subsubbranch.GetName()),
+                                                     subsubbranch.GetTotBytes("*"),
+                                                     subsubbranch.GetZipBytes("*")))
+                            ntot = subbranch.GetTotBytes()
+                            nzip = subbranch.GetZipBytes()
+                            for subsub_size in subsub_sizes:
+                                ntot = ntot + subsub_size[1]
+                                nzip = nzip + subsub_size[2]
+                        else:
+                            ntot = subbranch.GetTotBytes("*")
+                            nzip = subbranch.GetZipBytes("*")
                         ntotall = ntotall + ntot
                         nzipall = nzipall + nzip
                         if doprint:
@@ -149,61 +198,39 @@ def analyze(root, level, gtrees, gbranches, doprint, sorttype):
                                 comp = float(ntot) / float(nzip)
                             else:
                                 comp = 0.
-                            branch_key = None
-                            if sorttype == 1:
-                                branch_key = ntot
-                            elif sorttype == 2:
-                                branch_key = nzip
-                            else:
-                                branch_key = name
-                            branch_tuples[branch_key] = (ntot, nzip, comp, name)
+                            branch_tuples.append((ntot, nzip, comp, name))
                             #print('%14d%14d%8.2f  %s' % (ntot, nzip, comp, name))
 
                         # Remember information about branches.
                         
-                        if name in gbranches:
-                            gbranches[name][0] = gbranches[name][0] + ntot
-                            gbranches[name][1] = gbranches[name][1] + nzip
-                        else:
-                            gbranches[name] = [ntot, nzip]
+                        entry = gbranches.setdefault(name, [0, 0])
+                        entry[0] = entry[0] + ntot
+                        entry[1] = entry[1] + nzip
 
                         # Loop over subsubbranches (attributes of wrapped object).
                         
                         if level > 1:
-                            subsubbranches = subbranch.GetListOfBranches()
-                            for subsubbranch in subsubbranches:
-                                name = subsubbranch.GetName()
-                                ntot = subsubbranch.GetTotBytes("*")
-                                nzip = subsubbranch.GetZipBytes("*")
+                            for name, ntot, nzip in subsub_sizes:
                                 if doprint:
                                     if nzip != 0:
                                         comp = float(ntot) / float(nzip)
                                     else:
                                         comp = 0.
-                                branch_key = None
-                                if sorttype == 1:
-                                    branch_key = ntot
-                                elif sorttype == 2:
-                                    branch_key = nzip
-                                else:
-                                    branch_key = name
-                                    branch_tuples[branch_key] = (ntot, nzip, comp, name)
+                                    branch_tuples.append((ntot, nzip, comp, name))
                                     #print('%14d%14d%8.2f  %s' % (ntot, nzip, comp,
                                     #                             subsubbranch.GetName()))
 
                                 # Remember information about branches.
                         
-                                if name in gbranches:
-                                    gbranches[name][0] = gbranches[name][0] + ntot
-                                    gbranches[name][1] = gbranches[name][1] + nzip
-                                else:
-                                    gbranches[name] = [ntot, nzip]
+                                entry = gbranches.setdefault(name, [0, 0])
+                                entry[0] = entry[0] + ntot
+                                entry[1] = entry[1] + nzip
 
         # Print sorted information about branches.
 
         if doprint:
-            for branch_key in sorted(branch_tuples.keys()):
-                branch_tuple = branch_tuples[branch_key]
+            branch_tuples.sort(key=branch_sort_key(sorttype))
+            for branch_tuple in branch_tuples:
                 ntot = branch_tuple[0]
                 nzip = branch_tuple[1]
                 comp = branch_tuple[2]
@@ -234,11 +261,9 @@ def analyze(root, level, gtrees, gbranches, doprint, sorttype):
             print('%7.2f Mb average size per event.' % nevtot)
             print('%7.2f Mb average zipped size per event.' % nevzip)
 
-        if name in gbranches:
-            gbranches[name][0] = gbranches[name][0] + ntotall
-            gbranches[name][1] = gbranches[name][1] + nzipall
-        else:
-            gbranches[name] = [ntotall, nzipall]
+        entry = gbranches.setdefault(name, [0, 0])
+        entry[0] = entry[0] + ntotall
+        entry[1] = entry[1] + nzipall
 
 
     # Done.                     
@@ -321,8 +346,11 @@ def main(argv):
             
             filelistname = args[0][1:]
             if larbatch_posix.exists(filelistname):
-                for filename in larbatch_posix.readlines(filelistname):
-                    input_files.append(filename.strip())
+                f = larbatch_posix.open(filelistname)
+                data = f.read()
+                f.close()
+                input_files.extend([filename.strip() for filename in data.splitlines()
+                                    if filename.strip()])
             else:
                 print('File list %s does not exist.' % filelistname)
                 return 1
@@ -340,25 +368,52 @@ def main(argv):
     gbranches = {}
     nfile = 0
 
-    for input_file in input_files:
+    if nfilemax > 0:
+        input_files = input_files[:nfilemax]
 
-        if nfilemax > 0 and nfile >= nfilemax:
-            break
-        nfile = nfile + 1
+    # Files are opened concurrently, a limited number ahead, but analyzed
+    # in order in this thread.
 
-        if not larbatch_posix.exists(input_file):
-            print('Input file %s does not exist.' % input_file)
-            return 1
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=open_ahead)
+    futures = collections.deque()
+    pending = iter(input_files)
+    try:
+        for input_file in itertools.islice(pending, open_ahead):
+            futures.append((input_file, executor.submit(open_input, input_file)))
 
-        print('\nOpening %s' % input_file)
-        root = ROOT.TFile.Open(input_file)
-        if not root.IsOpen() or root.IsZombie():
-            print('Failed to open %s' % input_file)
-            return 1
+        while len(futures) > 0:
+            input_file, future = futures.popleft()
+            for next_file in itertools.islice(pending, 1):
+                futures.append((next_file, executor.submit(open_input, next_file)))
+            nfile = nfile + 1
+
+            exists, root = future.result()
+            if not exists:
+                print('Input file %s does not exist.' % input_file)
+                return 1
+
+            print('\nOpening %s' % input_file)
+            if not root or not root.IsOpen() or root.IsZombie():
+                print('Failed to open %s' % input_file)
+                return 1
+
+            # Analyze this file.
+
+            analyze(root, level, gtrees, gbranches, all, sorttype)
+            root.Close()
+    finally:
 
-        # Analyze this file.
-        
-        analyze(root, level, gtrees, gbranches, all, sorttype)
+        # Cancel opens that haven't started, wait for the rest, and close
+        # any files that were opened but not analyzed (early return).
+
+        for input_file, future in futures:
+            future.cancel()
+        executor.shutdown()
+        for input_file, future in futures:
+            if not future.cancelled() and future.exception() == None:
+                exists, root = future.result()
+                if root:
+                    root.Close()
 
     print('\n%d files analyzed.' % nfile)
                     
@@ -378,7 +433,7 @@ def main(argv):
     allname = 'All branches'
     ntot = 0
     nzip = 0
-    branch_tuples = {}
+    branch_tuples = []
     for key in sorted(gbranches.keys()):
         if key != allname:
             ntot = gbranches[key][0]
@@ -387,20 +442,13 @@ def main(argv):
                 comp = float(ntot) / float(nzip)
             else:
                 comp = 0.
-            branch_key = None
-            if sorttype == 1:
-                branch_key = ntot
-            elif sorttype == 2:
-                branch_key = nzip
-            else:
-                branch_key = key
-            branch_tuples[branch_key] = (ntot, nzip, comp, key)
+            branch_tuples.append((ntot, nzip, comp, key))
             #print('%14d%14d%8.2f  %s' % (ntot, nzip, comp, key))
 
     # Print sorted information about branches.
 
-    for branch_key in sorted(branch_tuples.keys()):
-        branch_tuple = branch_tuples[branch_key]
+    branch_tuples.sort(key=branch_sort_key(sorttype))
+    for branch_tuple in branch_tuples:
         ntot = branch_tuple[0]
         nzip = branch_tuple[1]
         comp = branch_tuple[2]
@@ -27,7 +27,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 import sys, os, json
-from larbatch_utilities import ifdh_cp
+from larbatch_utilities import ifdh_cp_batch
 import project_utilities
 import samweb_cli
 
@@ -332,7 +332,10 @@ def main():
         bad_list.close()
 
         # begin SAM decleration
+        # Copies to the dropbox are collected, and done together by
+        # ifdh_cp_batch (before returning).
 
+        dropbox_copies = []
         if declare_file:
 
             # Declare artroot files.
@@ -411,10 +414,12 @@ def main():
                         except samweb_cli.exceptions.SAMWebHTTPError as e:
                             print(e)
                             print('SAM declare failed.')
+                            ifdh_cp_batch(dropbox_copies)
                             return 1
              
                         except:
                             print('SAM declare failed.')
+                            ifdh_cp_batch(dropbox_copies)
                             return 1
                      
                     else:
@@ -427,7 +432,7 @@ def main():
                     dropbox_dir = project_utilities.get_dropbox(fn)
                     rootPath = os.path.join(dropbox_dir, fn)
                     jsonPath = rootPath + ".json"
-                    ifdh_cp(rootpath, rootPath)
+                    dropbox_copies.append((rootpath, rootPath))
 
             # Declare histogram files.
              
@@ -530,7 +535,11 @@ def main():
                     dropbox_dir = project_utilities.get_dropbox(fn)
                     rootPath = dropbox_dir + "/" + fn
                     jsonPath = rootPath + ".json"
-                    ifdh_cp(histpath, rootPath)
+                    dropbox_copies.append((histpath, rootPath))
+
+            # Do dropbox copies.
+
+            ifdh_cp_batch(dropbox_copies)
              
         return status
     